@@ -9,8 +9,16 @@ from nonebot import get_driver
 from nonebot.plugin import PluginMetadata
 
 from .constants import ELEMENT_COEFFICIENTS, REALMS
-from .cultivation import cultivate
-from .database import init_db
+from .cultivation import (SECLUSION_MAX_TIME, calc_seclusion, cultivate,
+                          format_duration)
+from .cache import close_user_cache, start_user_cache
+from .cooldown import close_cooldowns, start_cooldowns
+from .database import init_db, start_db_maintenance, stop_db_maintenance
+from .event_sink import close_event_sink, start_event_sink
+from .leaderboard import load_leaderboard
+from .log import logger, setup_log_sinks
+from .metrics import start_metrics, stop_metrics
+from .retention import start_event_rollup, stop_event_rollup
 
 # 插件元数据
 __plugin_meta__ = PluginMetadata(
@@ -19,16 +27,19 @@ __plugin_meta__ = PluginMetadata(
     usage="""基础命令：
     创建角色 - 开始你的修仙之旅
     修炼 - 提升修为
+    闭关/出关 - 闭关自动积累修为，出关时结算
     渡劫 - 突破境界
     门派相关 - 创建/加入/退出/查看门派
     PK - 与其他道友切磋
-    探索 - 探索机缘""",
+    探索 - 探索机缘
+    修仙排行 - 查看战力排行""",
     type="application",
     homepage="https://github.com/yourusername/nonebot_plugin_dujie",
     supported_adapters={"~onebot.v11"},
 )
 
-from .exploration import apply_event_effect, get_available_events
+from .exploration import (apply_event_effect, get_available_events,
+                          start_catalogue_reload, stop_catalogue_reload)
 
 from .pk import sect_pk, pk_command
 from .sect import appoint_elder, leave_sect, join_sect, sect_info, create_sect
@@ -38,10 +49,45 @@ dir_ = Path(__file__).parent
 
 # 初始化数据库
 driver = get_driver()
+# 日志文件在启动时才创建，导入插件时不打开文件、不启动写盘线程
+driver.on_startup(setup_log_sinks)
 driver.on_startup(init_db)
+driver.on_startup(start_db_maintenance)
+driver.on_startup(start_metrics)
+driver.on_startup(load_leaderboard)
+driver.on_startup(start_user_cache)
+driver.on_startup(start_cooldowns)
+driver.on_startup(start_event_sink)
+driver.on_startup(start_catalogue_reload)
+driver.on_startup(start_event_rollup)
+
+
+async def shutdown_plugin():
+    """按顺序关闭插件
+
+    各 NoneBot 版本执行多个关闭钩子的顺序不同，这里在一个钩子中依次执行：
+    先停止定时任务，再写完事件、冷却和用户缓存，最后执行数据库维护。
+    某一步出错时继续执行后面的步骤，避免缓存数据丢失。
+    """
+    for step in (
+        stop_metrics,
+        stop_event_rollup,
+        stop_catalogue_reload,
+        close_event_sink,
+        close_cooldowns,
+        close_user_cache,
+        stop_db_maintenance,
+    ):
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"插件关闭步骤 {step.__name__} 执行失败", e=e)
+
+
+driver.on_shutdown(shutdown_plugin)
 
 # 导入子模块
-from . import cultivation, sect, pk, tribulation
+from . import cultivation, sect, pk, tribulation, leaderboard
 
 import random
 import time
@@ -52,7 +98,12 @@ from nonebot.adapters.onebot.v11 import (Bot, GroupMessageEvent, Message,
 from nonebot.params import CommandArg
 from nonebot.typing import T_State
 
+from .cache import user_cache
+from .database import read_db
+from .event_sink import event_sink
+from .locks import user_locks
 from .models import PkRecord, Sect, XiuxianEvent, XiuxianUser
+from .render_cache import render_cache, status_key
 
 # 创建角色命令
 create_char = on_command("开始修仙", priority=5, block=True)
@@ -62,37 +113,40 @@ async def handle_create_char(bot: Bot, event: MessageEvent, state: T_State):
     """处理创建角色命令"""
     user_id = str(event.user_id)
     
-    # 检查用户是否已存在
-    user = await XiuxianUser.get_or_none(user_id=user_id)
-    if user:
-        await create_char.finish("道友已经创建过角色了！")
-        return
+    # 串行处理同一用户的命令，避免并发修改互相覆盖
+    async with user_locks.hold(user_id):
+        # 检查用户是否已存在
+        user = await user_cache.get(user_id)
+        if user:
+            await create_char.finish("道友已经创建过角色了！")
+            return
     
-    # 随机分配灵根
-    element = random.choice(list(ELEMENT_COEFFICIENTS.keys()))
+        # 随机分配灵根
+        element = random.choice(list(ELEMENT_COEFFICIENTS.keys()))
     
-    # 创建用户
-    user = await XiuxianUser.create(
-        user_id=user_id,
-        level=1,
-        exp=0,
-        element=element,
-        cultivation=0,
-        karma=0,
-        artifacts=[],
-        last_cultivation_time=0
-    )
+        # 创建用户
+        user = await XiuxianUser.create(
+            user_id=user_id,
+            level=1,
+            exp=0,
+            element=element,
+            cultivation=0,
+            karma=0,
+            artifacts=[],
+            last_cultivation_time=0
+        )
+        user_cache.put(user)
     
-    # 记录事件
-    await XiuxianEvent.create(
-        user=user,
-        event_type="创建角色",
-        event_name="踏上修仙之路",
-        exp_change=0,
-        karma_change=0
-    )
+        # 记录事件
+        await event_sink.emit(
+            user=user,
+            event_type="创建角色",
+            event_name="踏上修仙之路",
+            exp_change=0,
+            karma_change=0
+        )
     
-    await create_char.finish(f"恭喜道友踏上修仙之路！\n你的灵根是：{element}\n当前境界：练气期")
+        await create_char.finish(f"恭喜道友踏上修仙之路！\n你的灵根是：{element}\n当前境界：练气期")
 
 # 查看状态命令
 check_status = on_command("查看状态", priority=5, block=True)
@@ -103,15 +157,48 @@ async def handle_check_status(bot: Bot, event: MessageEvent, state: T_State):
     user_id = str(event.user_id)
     
     # 获取用户数据
-    user = await XiuxianUser.get_or_none(user_id=user_id)
+    user = await user_cache.get(user_id)
     if not user:
         await check_status.finish("道友还未创建角色，请先使用「开始修仙」命令！")
         return
     
-    # 获取最近事件
-    recent_events = await XiuxianEvent.filter(user=user).order_by('-created_at').limit(3)
+    # 状态未变化时直接使用上次的回复；闭关中的预估修为随时间变化，不缓存
+    key = status_key(user_id)
+    version = render_cache.version(key)
+    if not user.is_secluded:
+        cached = render_cache.get(key)
+        if cached is not None:
+            await check_status.finish(cached)
+            return
+    
+    # 获取最近事件：数据库中的历史记录从只读连接查询，与尚未写入的事件按时间合并。
+    # 事务中直接写库的事件（如PK）可能比队列中的事件更新，不能简单排在后面
+    stored = await (
+        XiuxianEvent.filter(user=user)
+        .using_db(read_db())
+        .order_by('-created_at')
+        .limit(3)
+    )
+    # 查询期间写入的事件可能同时出现在两边
+    seen = {(e.event_type, e.event_name, e.created_at) for e in stored}
+    pending = [
+        e for e in event_sink.pending(user.id, 3)
+        if (e.event_type, e.event_name, e.created_at) not in seen
+    ]
+    recent_events = sorted(
+        stored + pending, key=lambda e: e.created_at, reverse=True
+    )[:3]
     event_history = "\n".join([f"- {event.event_type}: {event.event_name}" for event in recent_events])
     
+    # 闭关中的修为只做预估，出关时才结算
+    seclusion = ""
+    if user.is_secluded:
+        elapsed = time.time() - user.seclusion_start
+        _, estimate = calc_seclusion(
+            user.level, user.cultivation, user.element, min(elapsed, SECLUSION_MAX_TIME)
+        )
+        seclusion = f"闭关：已闭关{format_duration(elapsed)}，出关可得修为约{estimate - user.cultivation}\n"
+    
     status_msg = f"""
 道友当前状态：
 境界：{user.get_realm_name()}
@@ -119,8 +206,10 @@ async def handle_check_status(bot: Bot, event: MessageEvent, state: T_State):
 灵根：{user.element}
 功德：{user.karma}
 法宝：{', '.join(user.artifacts) if user.artifacts else '无'}
-
+{seclusion}
 最近事件：
 {event_history}
 """
+    if not user.is_secluded:
+        render_cache.put(key, version, status_msg)
     await check_status.finish(status_msg)
\ No newline at end of file
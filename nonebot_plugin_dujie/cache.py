@@ -0,0 +1,370 @@
+"""
+用户数据缓存模块
+作者: biupiaa
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import nonebot
+from tortoise.expressions import F
+from tortoise.functions import Count, Sum
+from tortoise.transactions import in_transaction
+
+from .leaderboard import leaderboard
+from .locks import sect_key, user_locks
+from .log import logger
+from .metrics import metrics
+from .models import Sect, XiuxianUser
+from .render_cache import render_cache, sect_info_key, status_key
+from .scheduler import PeriodicTask
+
+config = nonebot.get_driver().config
+
+# 缓存容量、过期时间(秒)、回写间隔(秒)与每批回写行数
+CACHE_SIZE = int(getattr(config, "xiuxian_cache_size", 2000))
+CACHE_TTL = float(getattr(config, "xiuxian_cache_ttl", 600))
+FLUSH_INTERVAL = float(getattr(config, "xiuxian_flush_interval", 30))
+FLUSH_BATCH_SIZE = int(getattr(config, "xiuxian_flush_batch", 200))
+# 门派统计校准间隔(秒)
+RECONCILE_INTERVAL = float(getattr(config, "xiuxian_sect_reconcile_interval", 3600))
+
+
+class UserCache:
+    """XiuxianUser 写回式缓存
+
+    读取走内存 (LRU + TTL)，修改后调用 mark_dirty 标记，
+    由后台任务定时批量回写，关闭时再回写一次。
+
+    门派的成员数和总战力也在 mark_dirty 中按增量累计，
+    回写时与用户数据在同一事务中以原子增量提交。
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        """
+        Args:
+            max_size: 最多缓存的用户数
+            ttl: 缓存过期时间(秒)，脏数据在回写前不会过期
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (过期时间, 用户对象)，用户不存在时对象为 None
+        self._entries: "OrderedDict[str, Tuple[float, Optional[XiuxianUser]]]" = (
+            OrderedDict()
+        )
+        # 等待回写的用户，被淘汰出 _entries 后仍保留到回写完成
+        self._dirty: Dict[str, XiuxianUser] = {}
+        # 尚未提交的门派增量: sect_id -> [成员数, 总战力]
+        self._sect_deltas: Dict[int, List[int]] = {}
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    async def get(self, user_id: str) -> Optional[XiuxianUser]:
+        """获取用户，未命中时从数据库加载
+
+        Args:
+            user_id: 用户QQ号
+
+        Returns:
+            用户对象，不存在时返回 None
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            expire_at, user = entry
+            if expire_at > time.monotonic() or user_id in self._dirty:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                if metrics.enabled:
+                    metrics.cache_access(True)
+                return user
+            del self._entries[user_id]
+
+        self.misses += 1
+        if metrics.enabled:
+            metrics.cache_access(False)
+        user = self._dirty.get(user_id)
+        if user is None:
+            user = await XiuxianUser.get_or_none(user_id=user_id)
+            # 并发加载同一用户时以先写入缓存的对象为准
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] is not None:
+                return entry[1]
+            if user is not None:
+                self._remember_sect(user)
+        self._store(user_id, user)
+        return user
+
+    def put(self, user: XiuxianUser):
+        """放入新创建的用户"""
+        self._remember_sect(user)
+        leaderboard.update(user.user_id, user.combat_power)
+        render_cache.bump(status_key(user.user_id))
+        self._store(user.user_id, user)
+
+    def mark_dirty(self, user: XiuxianUser):
+        """标记用户已修改，等待回写"""
+        user.refresh_combat_power()
+        self._account_sect(user)
+        leaderboard.update(user.user_id, user.combat_power)
+        render_cache.bump(status_key(user.user_id))
+        self._dirty[user.user_id] = user
+        if user.user_id not in self._entries:
+            self._store(user.user_id, user)
+
+    def mark_committed(self, user: XiuxianUser):
+        """登记已由调用方在事务中直接写库的修改
+
+        只更新战斗力、门派增量和排行榜，不再回写该用户；
+        若用户仍有待回写数据或正在回写，则保留在脏表中，
+        避免回写的旧值覆盖刚提交的增量。
+        """
+        user.refresh_combat_power()
+        self._account_sect(user)
+        leaderboard.update(user.user_id, user.combat_power)
+        render_cache.bump(status_key(user.user_id))
+        if user.user_id in self._dirty or self._lock.locked():
+            self._dirty[user.user_id] = user
+        if user.user_id not in self._entries:
+            self._store(user.user_id, user)
+
+    async def get_sect_members(self, sect_id: int) -> List[XiuxianUser]:
+        """获取门派的全部成员，已缓存的用户使用缓存中的对象
+
+        查询前先回写脏数据，保证数据库中的门派归属与内存一致。
+        """
+        await self.flush()
+        members = []
+        for user in await XiuxianUser.filter(sect_id=sect_id):
+            cached = self._dirty.get(user.user_id)
+            entry = self._entries.get(user.user_id)
+            if cached is None and entry is not None:
+                cached = entry[1]
+            if cached is None:
+                self._remember_sect(user)
+                self._store(user.user_id, user)
+                cached = user
+            # 回写后到查询前可能有成员退出
+            if cached.sect_id == sect_id:
+                members.append(cached)
+        return members
+
+    def sect_stats(self, sect: Sect) -> Tuple[int, int]:
+        """获取门派成员数和总战力，包含尚未提交的增量
+
+        Returns:
+            (成员数, 总战力)
+        """
+        count, power = self._sect_deltas.get(sect.id, (0, 0))
+        return sect.member_count + count, sect.total_power + power
+
+    async def flush(self) -> int:
+        """批量回写所有脏数据
+
+        Returns:
+            回写的行数
+        """
+        async with self._lock:
+            return await self._flush()
+
+    @asynccontextmanager
+    async def hold_sect_members(self, *sect_ids: int, load: bool = True):
+        """持有门派及其全部成员的锁，返回各门派的成员列表
+
+        门派战按绝对值写回成员数据、门派统计校准按成员数据重写门派统计，
+        都必须同时持有成员的锁，否则会与成员同时提交的修仙PK等修改冲突。
+        成员名单只能在持有门派锁后确定，先按数据库中的名单加锁，
+        锁内发现未加锁的成员时按新名单重新加锁。
+
+        Args:
+            sect_ids: 门派ID
+            load: 是否加载成员，为 False 时只加锁并返回 None，不占用缓存
+        """
+        sect_keys = [sect_key(sect_id) for sect_id in sect_ids]
+        member_ids = await self._sect_member_ids(sect_ids)
+        while True:
+            async with user_locks.hold(*sect_keys, *member_ids):
+                if load:
+                    members = [await self.get_sect_members(i) for i in sect_ids]
+                    current = {user.user_id for group in members for user in group}
+                else:
+                    # 回写后数据库中的门派归属与内存一致
+                    await self.flush()
+                    members = None
+                    current = await self._sect_member_ids(sect_ids)
+                if current <= member_ids:
+                    yield members
+                    return
+            member_ids = current
+
+    async def _sect_member_ids(self, sect_ids) -> set:
+        """数据库中门派成员的QQ号"""
+        return set(
+            await XiuxianUser.filter(sect_id__in=sect_ids).values_list(
+                "user_id", flat=True
+            )
+        )
+
+    async def reconcile_sects(self) -> int:
+        """按成员数据重新统计门派成员数和总战力，修复增量维护产生的偏差
+
+        逐个门派持有其成员的锁后回写并统计。修仙PK等命令在事务提交后
+        才登记门派增量，不加锁时统计可能已包含尚未回写的增量，随后被重复累加。
+
+        Returns:
+            修复的门派数
+        """
+        fixed = 0
+        for sect_id in await Sect.all().values_list("id", flat=True):
+            async with self.hold_sect_members(sect_id, load=False):
+                async with self._lock:
+                    await self._flush()
+                    # 回写失败时增量仍未提交，留待下次校准
+                    if sect_id in self._sect_deltas:
+                        continue
+                    rows = await (
+                        XiuxianUser.filter(sect_id=sect_id)
+                        .annotate(
+                            member_count=Count("id"), total_power=Sum("combat_power")
+                        )
+                        .group_by("sect_id")
+                        .values("member_count", "total_power")
+                    )
+                    stats = (0, 0)
+                    if rows:
+                        stats = (rows[0]["member_count"], rows[0]["total_power"] or 0)
+                    sect = await Sect.filter(id=sect_id).values(
+                        "member_count", "total_power"
+                    )
+                    if sect and stats != (
+                        sect[0]["member_count"],
+                        sect[0]["total_power"],
+                    ):
+                        await Sect.filter(id=sect_id).update(
+                            member_count=stats[0], total_power=stats[1]
+                        )
+                        render_cache.bump(sect_info_key(sect_id))
+                        fixed += 1
+        if fixed:
+            logger.info(f"门派统计校准完成, 修复 {fixed} 个门派")
+        return fixed
+
+    async def _flush(self) -> int:
+        if not self._dirty and not self._sect_deltas:
+            return 0
+        users = list(self._dirty.values())
+        deltas = self._sect_deltas
+        self._dirty.clear()
+        self._sect_deltas = {}
+        # 只回写有变化的字段，回写期间再次修改的值留待下次回写
+        values = [user.field_values() for user in users]
+        fields = sorted({name for user in users for name in user.changed_fields()})
+        try:
+            async with in_transaction():
+                if fields:
+                    for i in range(0, len(users), FLUSH_BATCH_SIZE):
+                        await XiuxianUser.bulk_update(
+                            users[i : i + FLUSH_BATCH_SIZE], fields=fields
+                        )
+                for sect_id, (count, power) in deltas.items():
+                    await Sect.filter(id=sect_id).update(
+                        member_count=F("member_count") + count,
+                        total_power=F("total_power") + power,
+                    )
+        except Exception as e:
+            # 回写失败则放回脏表，下次重试；期间再次修改的对象以新的为准
+            for user in users:
+                self._dirty.setdefault(user.user_id, user)
+            for sect_id, (count, power) in deltas.items():
+                self._add_sect_delta(sect_id, count, power)
+            logger.error(f"用户缓存回写失败, 共 {len(users)} 条", e=e)
+            return 0
+        for user, user_values in zip(users, values):
+            user.mark_clean(user_values)
+        # 回写期间渲染的门派信息可能少算了增量
+        for sect_id in deltas:
+            render_cache.bump(sect_info_key(sect_id))
+        self.flushes += 1
+        self.flushed_rows += len(users)
+        if logger.enabled("DEBUG"):
+            logger.debug(f"用户缓存回写 {len(users)} 条, 统计: {self.stats()}")
+        return len(users)
+
+    def invalidate(self, user_id: str):
+        """丢弃缓存中的用户（不影响待回写数据）"""
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
+
+    def _remember_sect(self, user: XiuxianUser):
+        """记录已计入门派统计的门派和战力"""
+        user._sect_counted = (user.sect_id or 0, user.combat_power)
+
+    def _account_sect(self, user: XiuxianUser):
+        """根据用户变化累计门派增量"""
+        old_sect, old_power = getattr(
+            user, "_sect_counted", (user.sect_id or 0, user.combat_power)
+        )
+        new_sect, new_power = user.sect_id or 0, user.combat_power
+        if old_sect == new_sect:
+            if new_sect and new_power != old_power:
+                self._add_sect_delta(new_sect, 0, new_power - old_power)
+        else:
+            if old_sect:
+                self._add_sect_delta(old_sect, -1, -old_power)
+            if new_sect:
+                self._add_sect_delta(new_sect, 1, new_power)
+        user._sect_counted = (new_sect, new_power)
+
+    def _add_sect_delta(self, sect_id: int, count: int, power: int):
+        delta = self._sect_deltas.setdefault(sect_id, [0, 0])
+        delta[0] += count
+        delta[1] += power
+        render_cache.bump(sect_info_key(sect_id))
+
+    def _store(self, user_id: str, user: Optional[XiuxianUser]):
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+user_cache = UserCache()
+
+flush_task = PeriodicTask("用户缓存回写", FLUSH_INTERVAL, user_cache.flush)
+reconcile_task = PeriodicTask(
+    "门派统计校准", RECONCILE_INTERVAL, user_cache.reconcile_sects
+)
+
+
+async def start_user_cache():
+    """校准门派统计并启动定时任务"""
+    await reconcile_task.run_once()
+    flush_task.start()
+    reconcile_task.start()
+
+
+async def close_user_cache():
+    """停止定时任务并回写剩余数据"""
+    await reconcile_task.stop()
+    await flush_task.stop()
+    await user_cache.flush()
@@ -24,4 +24,13 @@ ELEMENT_COEFFICIENTS = {
     "水": 1.0,
     "火": 0.9,
     "土": 0.8
-} 
\ No newline at end of file
+}
+
+# 灵根战力加成
+ELEMENT_POWER_BONUS = {
+    "金": 300,
+    "木": 200,
+    "水": 250,
+    "火": 350,
+    "土": 150
+}
@@ -0,0 +1,204 @@
+"""
+命令冷却与每日次数模块
+作者: biupiaa
+"""
+
+import heapq
+import time
+from datetime import date
+from typing import Dict, List, Optional, Set, Tuple
+
+import nonebot
+from tortoise.transactions import in_transaction
+
+from .log import logger
+from .models import XiuxianCooldown
+from .scheduler import PeriodicTask
+
+config = nonebot.get_driver().config
+
+# 修炼冷却(秒)、PK冷却(秒)与每日探索次数
+CULTIVATE_CD = float(getattr(config, "xiuxian_cd_time", 3600))
+PK_CD = float(getattr(config, "xiuxian_pk_cd", 7200))
+DAILY_LIMIT = int(getattr(config, "xiuxian_daily_limit", 3))
+# 冷却数据回写间隔(秒)
+COOLDOWN_FLUSH_INTERVAL = float(getattr(config, "xiuxian_cooldown_flush_interval", 10))
+
+
+class CooldownService:
+    """内存中的命令冷却与每日次数
+
+    冷却截止时间和当日次数以「命令:用户QQ号」为键保存在内存中，
+    处理器在读取用户数据之前检查，刷屏消息不会访问数据库。
+    过期的冷却通过最小堆惰性清理，修改过的键由后台任务批量写入数据库，
+    重启后从数据库恢复。数据库中的过期记录由回写任务每天清理一次。
+    """
+
+    def __init__(self):
+        # 键 -> 冷却截止时间戳
+        self._deadlines: Dict[str, float] = {}
+        # (截止时间戳, 键) 最小堆，用于清理过期冷却
+        self._expiry: List[Tuple[float, str]] = []
+        # 键 -> 当日使用次数
+        self._counts: Dict[str, int] = {}
+        self._day = date.today()
+        # 等待回写的键，以及数据库中已有记录的键
+        self._dirty: Set[str] = set()
+        self._persisted: Set[str] = set()
+        # 上次清理过期记录的日期
+        self._purged_day: Optional[date] = None
+        self.rejected = 0
+
+    def remaining(self, command: str, user_id: str) -> int:
+        """获取剩余冷却时间
+
+        Returns:
+            剩余秒数，可以执行时返回 0
+        """
+        deadline = self._deadlines.get(f"{command}:{user_id}", 0)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return 0
+        self.rejected += 1
+        return int(remaining) + 1
+
+    def start(self, command: str, user_id: str, seconds: float):
+        """开始冷却"""
+        now = time.time()
+        self._purge(now)
+        key = f"{command}:{user_id}"
+        deadline = now + seconds
+        self._deadlines[key] = deadline
+        heapq.heappush(self._expiry, (deadline, key))
+        self._dirty.add(key)
+
+    def used(self, command: str, user_id: str) -> int:
+        """获取当日已使用次数"""
+        self._roll_day()
+        return self._counts.get(f"{command}:{user_id}", 0)
+
+    def exhausted(self, command: str, user_id: str, limit: int) -> bool:
+        """当日次数是否已用完"""
+        if self.used(command, user_id) < limit:
+            return False
+        self.rejected += 1
+        return True
+
+    def consume(self, command: str, user_id: str):
+        """当日次数加一"""
+        self._roll_day()
+        key = f"{command}:{user_id}"
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._dirty.add(key)
+
+    async def load(self):
+        """从数据库恢复未过期的冷却和当日次数，并清理过期记录"""
+        now = time.time()
+        self._roll_day()
+        for row in await XiuxianCooldown.all():
+            if row.deadline > now:
+                self._deadlines[row.key] = row.deadline
+                self._expiry.append((row.deadline, row.key))
+            if row.day == self._day and row.count:
+                self._counts[row.key] = row.count
+            if row.deadline > now or row.day == self._day:
+                self._persisted.add(row.key)
+        heapq.heapify(self._expiry)
+        await self._delete_expired(now)
+        self._purged_day = self._day
+
+    async def flush(self) -> int:
+        """批量写入修改过的冷却和次数
+
+        Returns:
+            写入的行数
+        """
+        self._roll_day()
+        purge = self._purged_day != self._day
+        if not self._dirty and not purge:
+            return 0
+        keys = list(self._dirty)
+        self._dirty.clear()
+        rows = [
+            XiuxianCooldown(
+                key=key,
+                deadline=self._deadlines.get(key, 0),
+                day=self._day,
+                count=self._counts.get(key, 0),
+            )
+            for key in keys
+        ]
+        updated = [row for row in rows if row.key in self._persisted]
+        created = [row for row in rows if row.key not in self._persisted]
+        try:
+            async with in_transaction():
+                if updated:
+                    await XiuxianCooldown.bulk_update(
+                        updated, fields=["deadline", "day", "count"]
+                    )
+                if created:
+                    await XiuxianCooldown.bulk_create(created)
+                # 刚写入的记录都是当日的，不会被清理
+                expired = await self._delete_expired(time.time()) if purge else []
+        except Exception as e:
+            self._dirty.update(keys)
+            logger.error(f"冷却数据回写失败, 共 {len(rows)} 条", e=e)
+            return 0
+        self._persisted.update(keys)
+        if purge:
+            self._persisted.difference_update(expired)
+            self._purged_day = self._day
+        return len(rows)
+
+    def stats(self) -> dict:
+        """冷却统计信息"""
+        return {
+            "cooling": len(self._deadlines),
+            "counted": len(self._counts),
+            "dirty": len(self._dirty),
+            "rejected": self.rejected,
+        }
+
+    async def _delete_expired(self, now: float) -> List[str]:
+        """删除冷却已结束且不是当日的记录
+
+        Returns:
+            删除的键
+        """
+        expired = XiuxianCooldown.filter(deadline__lte=now).exclude(day=self._day)
+        keys = await expired.values_list("key", flat=True)
+        if keys:
+            await expired.delete()
+        return keys
+
+    def _purge(self, now: float):
+        """清理已过期的冷却"""
+        while self._expiry and self._expiry[0][0] <= now:
+            deadline, key = heapq.heappop(self._expiry)
+            # 堆中可能有同一键的旧记录，只删除仍对应的截止时间
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+
+    def _roll_day(self):
+        """跨天时清空当日次数"""
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._counts.clear()
+
+
+cooldowns = CooldownService()
+
+flush_task = PeriodicTask("冷却数据回写", COOLDOWN_FLUSH_INTERVAL, cooldowns.flush)
+
+
+async def start_cooldowns():
+    """恢复冷却数据并启动回写任务"""
+    await cooldowns.load()
+    flush_task.start()
+
+
+async def close_cooldowns():
+    """停止回写任务并写入剩余数据"""
+    await flush_task.stop()
+    await cooldowns.flush()
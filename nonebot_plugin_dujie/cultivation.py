@@ -5,13 +5,68 @@
 
 import random
 import time
+from typing import Tuple
 
+import nonebot
 from nonebot import on_command
 from nonebot.adapters.onebot.v11 import Bot, MessageEvent
 from nonebot.typing import T_State
 
+from .cache import user_cache
 from .constants import ELEMENT_COEFFICIENTS, REALMS
-from .models import XiuxianUser, XiuxianEvent
+from .cooldown import CULTIVATE_CD, cooldowns
+from .event_sink import event_sink
+from .formulas import CULTIVATION_NOISE, breakthrough_cultivation, cultivation_gain
+from .locks import user_locks
+
+config = nonebot.get_driver().config
+
+# 闭关收益倍率（相对按冷却连续修炼的期望值）与最长结算时间(秒)
+SECLUSION_RATE = float(getattr(config, "xiuxian_seclusion_rate", 1.0))
+SECLUSION_MAX_TIME = float(getattr(config, "xiuxian_seclusion_max_time", 259200))
+
+
+def calc_seclusion(level: int, cultivation: int, element: str, seconds: float) -> Tuple[int, int]:
+    """计算闭关一段时间后的境界和修为
+
+    闭关每秒获得的修为为每次修炼的期望收益除以修炼冷却，随境界提升而增加。
+    逐个境界求出达到突破修为的时间，突破规则与修炼相同，
+    整段时间一次算完，循环次数不超过境界数。
+
+    Args:
+        level: 闭关前境界
+        cultivation: 闭关前修为
+        element: 灵根
+        seconds: 闭关时长(秒)
+
+    Returns:
+        (境界, 修为)
+    """
+    rate_per_level = (1 + ELEMENT_COEFFICIENTS[element]) * SECLUSION_RATE / CULTIVATE_CD
+    value = float(cultivation)
+    remaining = seconds
+    while remaining > 0:
+        rate = level * rate_per_level
+        next_level = level + 1
+        required = breakthrough_cultivation(next_level)
+        if next_level not in REALMS or rate <= 0:
+            value += rate * remaining
+            break
+        # 达到突破修为所需时间，已达到时立即突破
+        needed = max(0.0, (required - value) / rate)
+        if needed > remaining:
+            value += rate * remaining
+            break
+        value = max(value, required)
+        remaining -= needed
+        level = next_level
+    return level, int(value)
+
+
+def format_duration(seconds: float) -> str:
+    """格式化时长"""
+    hours, minutes = divmod(int(seconds) // 60, 60)
+    return f"{hours}小时{minutes}分钟" if hours else f"{minutes}分钟"
 
 # 修炼命令
 cultivate = on_command("修炼", priority=5, block=True)
@@ -21,46 +76,137 @@ async def handle_cultivate(bot: Bot, event: MessageEvent, state: T_State):
     """处理修炼命令"""
     user_id = str(event.user_id)
     
-    # 获取用户数据
-    user = await XiuxianUser.get_or_none(user_id=user_id)
-    if not user:
-        await cultivate.finish("道友还未创建角色，请先使用「开始修仙」命令！")
-        return
-    
-    current_time = time.time()
-    
-    # 检查修炼冷却时间（1小时）
-    if current_time - user.last_cultivation_time < 3600:
-        remaining_time = int(3600 - (current_time - user.last_cultivation_time))
-        await cultivate.finish(f"道友需要休息片刻，{remaining_time}秒后可以继续修炼。")
-        return
-    
-    # 计算本次修炼获得的修为
-    base_exp = user.level * (1 + ELEMENT_COEFFICIENTS[user.element])
-    # 添加随机波动
-    exp_gain = int(base_exp * (1 + random.uniform(-0.2, 0.2)))
-    
-    # 更新用户数据
-    user.cultivation += exp_gain
-    user.last_cultivation_time = current_time
-    
-    # 检查是否可以突破
-    next_level = user.level + 1
-    if next_level in REALMS and user.cultivation >= next_level * 1000:
-        user.level = next_level
-        event_name = f"突破到{REALMS[next_level]}"
-    else:
-        event_name = "日常修炼"
-    
-    await user.save()
-    
-    # 记录事件
-    await XiuxianEvent.create(
-        user=user,
-        event_type="修炼",
-        event_name=event_name,
-        exp_change=exp_gain,
-        karma_change=0
-    )
-    
-    await cultivate.finish(f"本次修炼获得{exp_gain}点修为。") 
\ No newline at end of file
+    # 串行处理同一用户的命令，避免并发修改互相覆盖
+    async with user_locks.hold(user_id):
+        # 冷却中直接拒绝，不读取用户数据
+        remaining_time = cooldowns.remaining("修炼", user_id)
+        if remaining_time:
+            await cultivate.finish(f"道友需要休息片刻，{remaining_time}秒后可以继续修炼。")
+            return
+    
+        # 获取用户数据
+        user = await user_cache.get(user_id)
+        if not user:
+            await cultivate.finish("道友还未创建角色，请先使用「开始修仙」命令！")
+            return
+    
+        if user.is_secluded:
+            await cultivate.finish("道友正在闭关，修为会自动积累，使用「出关」即可结算。")
+            return
+    
+        current_time = time.time()
+    
+        # 检查修炼冷却时间（兼容冷却数据尚未记录的旧存档）
+        if current_time - user.last_cultivation_time < CULTIVATE_CD:
+            remaining_time = int(CULTIVATE_CD - (current_time - user.last_cultivation_time))
+            await cultivate.finish(f"道友需要休息片刻，{remaining_time}秒后可以继续修炼。")
+            return
+    
+        # 计算本次修炼获得的修为
+        exp_gain = cultivation_gain(
+            user.level,
+            ELEMENT_COEFFICIENTS[user.element],
+            # 添加随机波动
+            random.uniform(-CULTIVATION_NOISE, CULTIVATION_NOISE),
+        )
+    
+        # 更新用户数据
+        user.cultivation += exp_gain
+        user.last_cultivation_time = current_time
+    
+        # 检查是否可以突破
+        next_level = user.level + 1
+        if next_level in REALMS and user.cultivation >= breakthrough_cultivation(next_level):
+            user.level = next_level
+            event_name = f"突破到{REALMS[next_level]}"
+        else:
+            event_name = "日常修炼"
+    
+        user_cache.mark_dirty(user)
+        cooldowns.start("修炼", user_id, CULTIVATE_CD)
+    
+        # 记录事件
+        await event_sink.emit(
+            user=user,
+            event_type="修炼",
+            event_name=event_name,
+            exp_change=exp_gain,
+            karma_change=0
+        )
+    
+        await cultivate.finish(f"本次修炼获得{exp_gain}点修为。")
+
+# 闭关命令
+seclude = on_command("闭关", priority=5, block=True)
+
+@seclude.handle()
+async def handle_seclude(bot: Bot, event: MessageEvent, state: T_State):
+    """处理闭关命令"""
+    user_id = str(event.user_id)
+    
+    async with user_locks.hold(user_id):
+        user = await user_cache.get(user_id)
+        if not user:
+            await seclude.finish("道友还未创建角色，请先使用「开始修仙」命令！")
+            return
+    
+        if user.is_secluded:
+            elapsed = time.time() - user.seclusion_start
+            await seclude.finish(f"道友已闭关{format_duration(elapsed)}，使用「出关」即可结算修为。")
+            return
+    
+        # 只记录开始时间，闭关期间不产生任何数据库读写
+        user.seclusion_start = time.time()
+        user_cache.mark_dirty(user)
+    
+        await seclude.finish(
+            f"道友开始闭关，修为将随时间自动积累（最多结算{format_duration(SECLUSION_MAX_TIME)}），"
+            "使用「出关」结束闭关。"
+        )
+
+# 出关命令
+emerge = on_command("出关", priority=5, block=True)
+
+@emerge.handle()
+async def handle_emerge(bot: Bot, event: MessageEvent, state: T_State):
+    """处理出关命令"""
+    user_id = str(event.user_id)
+    
+    async with user_locks.hold(user_id):
+        user = await user_cache.get(user_id)
+        if not user:
+            await emerge.finish("道友还未创建角色，请先使用「开始修仙」命令！")
+            return
+    
+        if not user.is_secluded:
+            await emerge.finish("道友并未闭关，使用「闭关」开始闭关修炼。")
+            return
+    
+        # 一次结算整个闭关期间的修为和突破
+        elapsed = time.time() - user.seclusion_start
+        old_level, old_cultivation = user.level, user.cultivation
+        user.level, user.cultivation = calc_seclusion(
+            user.level, user.cultivation, user.element, min(elapsed, SECLUSION_MAX_TIME)
+        )
+        user.seclusion_start = 0
+        user_cache.mark_dirty(user)
+    
+        exp_gain = user.cultivation - old_cultivation
+        if user.level > old_level:
+            event_name = f"闭关突破到{REALMS[user.level]}"
+        else:
+            event_name = "闭关修炼"
+    
+        # 记录事件
+        await event_sink.emit(
+            user=user,
+            event_type="闭关",
+            event_name=event_name,
+            exp_change=exp_gain,
+            karma_change=0
+        )
+    
+        msg = f"道友闭关{format_duration(elapsed)}，获得{exp_gain}点修为。"
+        if user.level > old_level:
+            msg += f"\n恭喜道友突破到{REALMS[user.level]}！"
+        await emerge.finish(msg)
@@ -3,25 +3,101 @@
 作者: biupiaa
 """
 
+import asyncio
+import copy
+import hashlib
 import os
-from typing import List, Tuple, Any
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
 
 import nonebot
 from nonebot.utils import is_coroutine_callable
-from tortoise import Tortoise
+from tortoise import Tortoise, fields
+from tortoise.backends.base.config_generator import expand_db_url
 from tortoise.connection import connections
 from tortoise.models import Model as Model_
+from tortoise.utils import get_schema_sql
 
 from .log import logger
+from .scheduler import PeriodicTask
 
 # 存储所有模型和SQL脚本方法
 SCRIPT_METHOD: List[Tuple[str, Any]] = []
 MODELS: List[str] = []
 
+# 记录已执行的版本化迁移
+MIGRATION_TABLE = "xiuxian_schema_migrations"
+# 记录上次建表和迁移完成时的数据库结构指纹
+SCHEMA_STATE_TABLE = "xiuxian_schema_state"
+
 config = nonebot.get_driver().config
 
+# 数据库结构指纹未变化时跳过建表和版本化迁移，手动改过表结构时可关闭
+SCHEMA_FINGERPRINT = bool(getattr(config, "xiuxian_schema_fingerprint", True))
+
+# SQLite 连接时设置的 pragma，可用 XIUXIAN_SQLITE_<名称> 覆盖，设为空则不设置；
+# 数据库地址中带有同名参数时以地址为准
+SQLITE_PRAGMAS = {
+    name: getattr(config, f"xiuxian_sqlite_{name}", default)
+    for name, default in (
+        # WAL 下读写互不阻塞，提交只追加写日志文件
+        ("journal_mode", "WAL"),
+        # WAL 下 NORMAL 只在检查点时同步磁盘，断电可能丢失最近的提交但不会损坏数据库
+        ("synchronous", "NORMAL"),
+        # 页缓存，负数表示 KiB
+        ("cache_size", -65536),
+        # 内存映射读取的字节数
+        ("mmap_size", 268435456),
+        # 临时表和排序使用内存
+        ("temp_store", "MEMORY"),
+        # 数据库被锁定时等待的毫秒数
+        ("busy_timeout", 5000),
+    )
+}
+# SQLite 定时执行 wal_checkpoint 和 optimize 的间隔(秒)，0表示只在关闭时执行
+SQLITE_MAINTENANCE_INTERVAL = float(
+    getattr(config, "xiuxian_sqlite_maintenance_interval", 3600)
+)
+
+# MySQL/PostgreSQL 连接池配置，未配置的项使用驱动默认值，数据库地址中的同名参数优先
+DB_POOL = {
+    name: getattr(config, f"xiuxian_db_pool_{name}", None)
+    for name in ("min", "max", "recycle", "timeout")
+}
+# 各后端的连接池参数名: 最小连接数、最大连接数、连接回收时间(秒)、连接超时(秒)
+POOL_PARAMS = {
+    "tortoise.backends.mysql": {
+        "min": "minsize",
+        "max": "maxsize",
+        "recycle": "pool_recycle",
+        "timeout": "connect_timeout",
+    },
+    "tortoise.backends.asyncpg": {
+        "min": "minsize",
+        "max": "maxsize",
+        "recycle": "max_inactive_connection_lifetime",
+        "timeout": "timeout",
+    },
+    "tortoise.backends.psycopg": {
+        "min": "minsize",
+        "max": "maxsize",
+        "recycle": "max_lifetime",
+        "timeout": "timeout",
+    },
+}
+
+# 只读连接的数据库地址（如只读副本），查看类命令的查询走这个连接，
+# 未配置时使用主库
+DB_READ_URL = getattr(config, "xiuxian_db_read_url", None) or None
+READ_CONNECTION = "read"
+
+
 class Model(Model_):
-    """自动注册的模型基类"""
+    """自动注册的模型基类
+
+    从数据库加载或保存后记录各字段的值，save() 未指定 update_fields 时
+    只更新有变化的字段，JSON 字段按值比较。
+    """
     
     def __init_subclass__(cls, **kwargs):
         """子类初始化时自动注册到MODELS列表"""
@@ -31,6 +107,116 @@ class Model(Model_):
         if func := getattr(cls, "_run_script", None):
             SCRIPT_METHOD.append((cls.__module__, func))
 
+    @classmethod
+    def _init_from_db(cls, **kwargs):
+        instance = super()._init_from_db(**kwargs)
+        if not instance._partial:
+            instance.mark_clean()
+        return instance
+
+    @classmethod
+    def _tracked_fields(cls) -> Tuple[str, ...]:
+        """参与变更比较的字段：主键和自动时间字段除外"""
+        tracked = _TRACKED_FIELDS.get(cls)
+        if tracked is None:
+            meta = cls._meta
+            tracked = tuple(
+                name
+                for name in meta.fields_db_projection
+                if name != meta.pk_attr
+                and not getattr(meta.fields_map[name], "auto_now", False)
+                and not getattr(meta.fields_map[name], "auto_now_add", False)
+            )
+            _TRACKED_FIELDS[cls] = tracked
+        return tracked
+
+    def field_values(self) -> Dict[str, Any]:
+        """当前各字段的值，JSON 字段为深拷贝"""
+        values = {}
+        for name in self._tracked_fields():
+            value = getattr(self, name)
+            if isinstance(self._meta.fields_map[name], fields.JSONField):
+                value = copy.deepcopy(value)
+            values[name] = value
+        return values
+
+    def mark_clean(self, values: Optional[Dict[str, Any]] = None):
+        """将当前值（或给定的 field_values 结果）记为与数据库一致"""
+        self._snapshot = self.field_values() if values is None else values
+
+    def changed_fields(self) -> List[str]:
+        """自加载或上次保存以来有变化的字段，未记录过时返回全部字段"""
+        snapshot = getattr(self, "_snapshot", None)
+        if snapshot is None:
+            return list(self._tracked_fields())
+        return [
+            name
+            for name in self._tracked_fields()
+            if getattr(self, name) != snapshot.get(name)
+        ]
+
+    async def save(
+        self, using_db=None, update_fields=None, force_create=False, force_update=False
+    ):
+        """保存模型，已入库且未指定 update_fields 时只更新有变化的字段"""
+        if (
+            update_fields is None
+            and self._saved_in_db
+            and not force_create
+            and getattr(self, "_snapshot", None) is not None
+        ):
+            update_fields = self.changed_fields()
+            if not update_fields:
+                return
+            # 自动更新时间随实际修改一起写入
+            update_fields += [
+                name
+                for name, field in self._meta.fields_map.items()
+                if getattr(field, "auto_now", False)
+            ]
+        # 保存前取值，保存期间的并发修改留待下次保存
+        values = self.field_values()
+        await super().save(using_db, update_fields, force_create, force_update)
+        if update_fields is None or getattr(self, "_snapshot", None) is None:
+            self.mark_clean(values)
+        else:
+            self._snapshot.update(
+                (name, values[name]) for name in update_fields if name in values
+            )
+
+    async def refresh_from_db(self, fields=None, using_db=None):
+        """从数据库刷新字段，并同步记录的字段值"""
+        await super().refresh_from_db(fields, using_db)
+        if getattr(self, "_snapshot", None) is not None:
+            values = self.field_values()
+            self._snapshot.update(
+                (name, values[name]) for name in fields or values if name in values
+            )
+
+
+# 各模型参与变更比较的字段
+_TRACKED_FIELDS: Dict[type, Tuple[str, ...]] = {}
+
+
+class SchemaMigration(Model):
+    """已执行的版本化迁移"""
+    version = fields.CharField(max_length=100, pk=True)
+
+    class Meta:
+        table = MIGRATION_TABLE
+        table_description = "数据库迁移记录表"
+
+
+class SchemaState(Model):
+    """数据库结构指纹"""
+    name = fields.CharField(max_length=50, pk=True)
+    fingerprint = fields.CharField(max_length=64)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = SCHEMA_STATE_TABLE
+        table_description = "数据库结构指纹表"
+
 
 class DbUrlIsNone(Exception):
     """数据库连接地址为空异常"""
@@ -43,7 +229,11 @@ class DbConnectError(Exception):
 
 
 async def init_db():
-    """初始化数据库连接"""
+    """初始化数据库连接
+
+    建表语句和版本化迁移的指纹与上次启动一致时，跳过 generate_schemas
+    和迁移脚本，不再逐表查询数据库目录。
+    """
     # 获取数据库URL
     db_url = config.db_url
     if not db_url:
@@ -51,47 +241,295 @@ async def init_db():
     
     try:
         # 初始化数据库连接
-        await Tortoise.init(
-            db_url=db_url,
-            modules={"models": MODELS},
-            timezone="Asia/Shanghai"
-        )
+        await Tortoise.init(config=tortoise_config(db_url))
+        db = Tortoise.get_connection("default")
         
+        # 收集SQL脚本方法，每个方法返回的脚本按顺序执行
+        scripts = []
+        # 各脚本对应模型的表名
+        tables = []
+        for module, func in SCRIPT_METHOD:
+            try:
+                sql = await func() if is_coroutine_callable(func) else func()
+                if sql:
+                    scripts.append(sql)
+                    tables.append(func.__self__._meta.db_table)
+            except Exception as e:
+                logger.debug(f"{module} 执行SCRIPT_METHOD方法出错...", e=e)
+
+        fingerprint = schema_fingerprint(db, scripts)
+        if SCHEMA_FINGERPRINT and await stored_fingerprint() == fingerprint:
+            # 只执行每次启动都要执行的普通脚本
+            await run_scripts(db, [
+                [item for item in sql if not isinstance(item, tuple)]
+                for sql in scripts
+            ])
+            logger.info("数据库加载成功! 表结构未变化，跳过建表和迁移")
+            return
+
+        # 表尚未创建的模型由 generate_schemas 直接建成最新结构，
+        # 其迁移只需记为已执行，普通脚本在建表后执行
+        missing = await missing_tables(db, tables)
+        existing = [sql for sql, table in zip(scripts, tables) if table not in missing]
+        created = [sql for sql, table in zip(scripts, tables) if table in missing]
+
         # 执行SQL脚本方法
-        if SCRIPT_METHOD:
-            db = Tortoise.get_connection("default")
+        if scripts:
             logger.debug(
                 "即将运行SCRIPT_METHOD方法, 合计 "
-                f"<u><y>{len(SCRIPT_METHOD)}</y></u> 个..."
+                f"<u><y>{len(scripts)}</y></u> 个..."
             )
-            sql_list = []
-            
-            for module, func in SCRIPT_METHOD:
-                try:
-                    sql = await func() if is_coroutine_callable(func) else func()
-                    if sql:
-                        sql_list += sql
-                except Exception as e:
-                    logger.debug(f"{module} 执行SCRIPT_METHOD方法出错...", e=e)
-            
-            for sql in sql_list:
-                logger.debug(f"执行SQL: {sql}")
-                try:
-                    await db.execute_query_dict(sql)
-                except Exception as e:
-                    logger.debug(f"执行SQL: {sql} 错误...", e=e)
-            
-            if sql_list:
-                logger.debug("SCRIPT_METHOD方法执行完毕!")
+        complete = await run_scripts(db, existing)
         
         # 生成数据库表
         await Tortoise.generate_schemas()
+        if created:
+            complete = await run_scripts(db, created, mark_applied=True) and complete
+        if scripts:
+            logger.debug("SCRIPT_METHOD方法执行完毕!")
+        # 有迁移未能执行时不记录指纹，下次启动重试
+        if SCHEMA_FINGERPRINT and complete:
+            await SchemaState.update_or_create(
+                name="default", defaults={"fingerprint": fingerprint}
+            )
         logger.info("数据库加载成功!")
         
     except Exception as e:
         raise DbConnectError(f"数据库连接错误... e:{e}") from e
 
 
+def tortoise_config(db_url: str) -> Dict[str, Any]:
+    """由数据库地址生成 Tortoise 配置
+
+    配置了 DB_READ_URL 时增加只读连接，模型仍绑定主库，
+    只读连接只在查询显式 using_db(read_db()) 时使用。
+
+    Args:
+        db_url: 数据库地址
+    """
+    connections = {"default": connection_config(db_url)}
+    if DB_READ_URL:
+        connections[READ_CONNECTION] = connection_config(DB_READ_URL)
+    return {
+        "connections": connections,
+        "apps": {"models": {"models": MODELS, "default_connection": "default"}},
+        "timezone": "Asia/Shanghai",
+    }
+
+
+def connection_config(db_url: str) -> Dict[str, Any]:
+    """单个连接的配置，SQLite 附带 SQLITE_PRAGMAS，其他数据库附带连接池配置
+
+    Args:
+        db_url: 数据库地址
+    """
+    connection = expand_db_url(db_url)
+    credentials = connection["credentials"]
+    in_url = parse_qs(urlparse(db_url).query)
+    if connection["engine"] == "tortoise.backends.sqlite":
+        for name, value in SQLITE_PRAGMAS.items():
+            if name in in_url:
+                continue
+            if value in (None, ""):
+                credentials.pop(name, None)
+            else:
+                credentials[name] = value
+    params = POOL_PARAMS.get(connection["engine"], {})
+    for name, param in params.items():
+        value = DB_POOL[name]
+        if value not in (None, "") and param not in in_url:
+            credentials[param] = value
+    return connection
+
+
+def read_db():
+    """只读查询使用的连接，未配置 XIUXIAN_DB_READ_URL 时为主库
+
+    只读副本可能有复制延迟，只用于展示类查询，读取后要修改的数据仍走主库。
+    """
+    if DB_READ_URL:
+        return Tortoise.get_connection(READ_CONNECTION)
+    return Tortoise.get_connection("default")
+
+
+def schema_fingerprint(db, scripts: List[List[Any]]) -> str:
+    """建表语句和版本化迁移的指纹
+
+    建表语句由模型定义生成，不查询数据库；模型或迁移有变化时指纹随之变化。
+
+    Args:
+        db: 数据库连接
+        scripts: 各SCRIPT_METHOD返回的SQL列表
+    """
+    digest = hashlib.sha256(get_schema_sql(db, safe=True).encode())
+    for sql in scripts:
+        for item in sql:
+            if isinstance(item, tuple):
+                digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+async def stored_fingerprint() -> Optional[str]:
+    """上次启动记录的指纹，表不存在时返回 None"""
+    try:
+        state = await SchemaState.get_or_none(name="default")
+    except Exception:
+        return None
+    return state.fingerprint if state else None
+
+
+async def missing_tables(db, tables: List[str]) -> Set[str]:
+    """尚未创建的表，逐表试查判断
+
+    Args:
+        db: 数据库连接
+        tables: 表名列表
+    """
+    missing = set()
+    for table in set(tables):
+        try:
+            await db.execute_query(f"SELECT 1 FROM {table} WHERE 1 = 0")
+        except Exception:
+            missing.add(table)
+    return missing
+
+
+async def run_scripts(
+    db, scripts: List[List[Any]], mark_applied: bool = False
+) -> bool:
+    """执行SCRIPT_METHOD返回的SQL
+
+    普通字符串每次启动都会执行；(版本号, SQL) 形式的版本化迁移
+    执行成功后记录到迁移表，之后不再执行。同一个方法返回的SQL按顺序执行，
+    不同方法之间互不依赖，并发执行。
+
+    Args:
+        db: 数据库连接
+        scripts: 各SCRIPT_METHOD返回的SQL列表
+        mark_applied: 版本化迁移不执行，直接记为已执行（表刚按最新结构创建）
+
+    Returns:
+        版本化迁移是否都已执行
+    """
+    applied = set()
+    if any(isinstance(item, tuple) for sql in scripts for item in sql):
+        await db.execute_script(
+            f"CREATE TABLE IF NOT EXISTS {MIGRATION_TABLE} "
+            "(version VARCHAR(100) NOT NULL PRIMARY KEY);"
+        )
+        applied = set(await SchemaMigration.all().values_list("version", flat=True))
+
+    async def run(sql_list: List[Any]) -> bool:
+        complete = True
+        for item in sql_list:
+            version, sql = item if isinstance(item, tuple) else (None, item)
+            if version in applied:
+                continue
+            if version is not None and mark_applied:
+                await SchemaMigration.create(version=version)
+                logger.debug(f"新建的表无需迁移, {version} 记为已执行")
+                continue
+            logger.debug(f"执行SQL: {sql}")
+            try:
+                await db.execute_query_dict(sql)
+            except Exception as e:
+                logger.debug(f"执行SQL: {sql} 错误...", e=e)
+                # 字段或索引已存在说明迁移效果已生效，同样记为已执行
+                if version is None:
+                    continue
+                if not is_already_applied(e):
+                    complete = False
+                    continue
+            if version is not None:
+                await SchemaMigration.create(version=version)
+                logger.info(f"数据库迁移 {version} 执行完毕")
+        return complete
+
+    results = await asyncio.gather(*(run(sql) for sql in scripts))
+    return all(results)
+
+
+def is_already_applied(e: Exception) -> bool:
+    """判断迁移失败是否因为字段或索引已存在"""
+    message = str(e).lower()
+    return "duplicate" in message or "already exists" in message
+
+
+def create_index_sql(model, columns: List[str]) -> str:
+    """为已有表生成建索引语句
+
+    索引名与 generate_schemas 按 Meta.indexes 生成的一致，
+    新库和迁移后的旧库不会出现重复索引。MySQL 不支持 IF NOT EXISTS。
+
+    Args:
+        model: 模型类
+        columns: 索引列
+    """
+    db = Tortoise.get_connection("default")
+    name = db.schema_generator(db)._generate_index_name("idx", model, columns)
+    exists = "" if db.capabilities.dialect == "mysql" else "IF NOT EXISTS "
+    return (
+        f"CREATE INDEX {exists}{name} ON {model._meta.db_table} ({', '.join(columns)});"
+    )
+
+
+async def bulk_update_rows(model, objects: List[Any], update_fields: List[str]):
+    """按主键批量更新多行的指定字段
+
+    与 bulk_update 为每行拼接 CASE 表达式不同，这里只生成一条参数化的
+    UPDATE 语句并用 executemany 执行，一次更新上千行时快得多。
+    在 in_transaction 中调用时使用当前事务。
+
+    Args:
+        model: 模型类
+        objects: 要更新的模型对象
+        update_fields: 更新的字段
+    """
+    if not objects:
+        return
+    db = model._choose_db(True)
+    executor = db.executor_class(model=model, db=db)
+    sql = executor.get_update_sql(update_fields, None)
+    pk = model._meta.pk
+    values = [
+        [executor.column_map[field](getattr(obj, field), obj) for field in update_fields]
+        + [pk.to_db_value(obj.pk, obj)]
+        for obj in objects
+    ]
+    await db.execute_many(sql, values)
+
+
+def is_sqlite() -> bool:
+    """当前数据库是否为 SQLite"""
+    return Tortoise.get_connection("default").capabilities.dialect == "sqlite"
+
+
+async def maintain_sqlite():
+    """把 WAL 日志写回数据库并截断，再让 SQLite 按需更新查询统计"""
+    db = Tortoise.get_connection("default")
+    rows = await db.execute_query_dict("PRAGMA wal_checkpoint(TRUNCATE);")
+    await db.execute_script("PRAGMA optimize;")
+    logger.debug(f"SQLite 维护完成: {rows[0] if rows else ''}")
+
+
+maintenance_task = PeriodicTask(
+    "SQLite维护", SQLITE_MAINTENANCE_INTERVAL, maintain_sqlite
+)
+
+
+async def start_db_maintenance():
+    """SQLite 数据库启动定时维护"""
+    if is_sqlite() and SQLITE_MAINTENANCE_INTERVAL > 0:
+        maintenance_task.start()
+
+
+async def stop_db_maintenance():
+    """停止定时维护，关闭前再执行一次"""
+    await maintenance_task.stop()
+    if is_sqlite():
+        await maintenance_task.run_once()
+
+
 async def disconnect():
     """断开数据库连接"""
     await connections.close_all()
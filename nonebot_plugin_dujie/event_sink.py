@@ -0,0 +1,195 @@
+"""
+事件日志批量写入模块
+作者: biupiaa
+"""
+
+import asyncio
+from typing import Dict, List, Optional
+
+import nonebot
+from tortoise import timezone
+
+from .log import logger
+from .models import XiuxianEvent
+from .render_cache import render_cache, status_key
+
+config = nonebot.get_driver().config
+
+# 队列容量、每批写入条数与攒批等待时间(秒)
+QUEUE_SIZE = int(getattr(config, "xiuxian_event_queue_size", 10000))
+BATCH_SIZE = int(getattr(config, "xiuxian_event_batch", 200))
+BATCH_INTERVAL = float(getattr(config, "xiuxian_event_interval", 1))
+
+# 停止信号
+_STOP = object()
+
+
+class EventSink:
+    """XiuxianEvent 异步批量写入器
+
+    处理器通过 emit 投递事件后立即返回，后台任务按数量或时间阈值
+    使用 bulk_create 批量写入。队列满时 emit 会等待（背压），
+    关闭时保证写完队列中的全部事件。
+    """
+
+    def __init__(
+        self,
+        max_size: int = QUEUE_SIZE,
+        batch_size: int = BATCH_SIZE,
+        interval: float = BATCH_INTERVAL,
+    ):
+        """
+        Args:
+            max_size: 队列容量
+            batch_size: 每批最多写入条数
+            interval: 未攒满一批时的等待时间(秒)
+        """
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # 已投递但尚未写入的事件，按投递顺序排列，以对象 id 为键。
+        # 队列满时等待中的事件可能被后投递的事件超过，写入后按 id 移除
+        self._unsaved: Dict[int, XiuxianEvent] = {}
+        self.emitted = 0
+        self.written = 0
+        self.batches = 0
+        self.blocked = 0
+        self.failed = 0
+
+    def start(self):
+        """启动后台写入任务"""
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(self.max_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止写入任务，写完队列中剩余的事件"""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        # 写入任务退出后才投递的事件
+        while not self._queue.empty():
+            batch: List[XiuxianEvent] = []
+            self._take(batch)
+            await self._write(batch)
+        self._task = None
+        self._queue = None
+
+    async def emit(self, **kwargs):
+        """投递一条事件，参数同 XiuxianEvent.create"""
+        # 记录投递时间而不是写入时间
+        kwargs.setdefault("created_at", timezone.now())
+        event = XiuxianEvent(**kwargs)
+        self.emitted += 1
+        # 查看状态中展示最近事件
+        render_cache.bump(status_key(event.user.user_id))
+        if self._queue is None:
+            # 写入任务未运行时直接写库
+            await event.save()
+            self.written += 1
+            return
+        self._unsaved[id(event)] = event
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.blocked += 1
+            await self._queue.put(event)
+
+    def pending(self, user_id: int, limit: int) -> List[XiuxianEvent]:
+        """获取某用户尚未写入的最近事件，新的在前
+
+        Args:
+            user_id: 用户主键
+            limit: 最多返回条数
+        """
+        result = []
+        for event in reversed(self._unsaved.values()):
+            if len(result) >= limit:
+                break
+            if event.user_id == user_id:
+                result.append(event)
+        return result
+
+    def stats(self) -> dict:
+        """写入统计信息"""
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "emitted": self.emitted,
+            "written": self.written,
+            "batches": self.batches,
+            "blocked": self.blocked,
+            "failed": self.failed,
+        }
+
+    async def _run(self):
+        stopping = False
+        while not stopping or not self._queue.empty():
+            batch: List[XiuxianEvent] = []
+            if not stopping:
+                item = await self._queue.get()
+                if item is _STOP:
+                    stopping = True
+                    continue
+                batch.append(item)
+            stopping = self._take(batch) or stopping
+            if not stopping and len(batch) < self.batch_size:
+                await asyncio.sleep(self.interval)
+                stopping = self._take(batch) or stopping
+            if batch:
+                await self._write(batch)
+
+    def _take(self, batch: List[XiuxianEvent]) -> bool:
+        """从队列中取出事件直到攒满一批，遇到停止信号时返回 True"""
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+            if item is _STOP:
+                return True
+            batch.append(item)
+        return False
+
+    async def _write(self, batch: List[XiuxianEvent]):
+        try:
+            await XiuxianEvent.bulk_create(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            logger.warning(f"事件日志批量写入失败, 共 {len(batch)} 条, 改为逐条写入", e=e)
+            await self._write_rows(batch)
+        finally:
+            for event in batch:
+                self._unsaved.pop(id(event), None)
+            # 写入期间渲染的最近事件可能重复或缺失
+            for event in batch:
+                render_cache.bump(status_key(event.user.user_id))
+
+    async def _write_rows(self, batch: List[XiuxianEvent]):
+        """逐条写入，只丢弃本身无法写入的事件"""
+        for event in batch:
+            try:
+                await event.save()
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(
+                    f"事件日志写入失败: 用户 {event.user_id} {event.event_type}", e=e
+                )
+
+
+event_sink = EventSink()
+
+
+async def start_event_sink():
+    """启动事件写入任务"""
+    event_sink.start()
+
+
+async def close_event_sink():
+    """关闭事件写入任务"""
+    await event_sink.close()
@@ -2,170 +2,276 @@
 修仙游戏探索事件模块
 作者: biupiaa
 """
+import asyncio
+import json
 import random
+from pathlib import Path
 
+import nonebot
 from nonebot import on_command
 from nonebot.adapters.onebot.v11 import (Bot, MessageEvent)
 from nonebot.typing import T_State
 
-from .models import XiuxianEvent, XiuxianUser
-
-# 探索事件库
-EXPLORATION_EVENTS = [
-    # 基础事件 - 适合所有等级的道友
-    {
-        "name": "灵药园",
-        "description": "道友在深山中发现了一片灵药园，灵气充沛，药草芬芳。",
-        "type": "收益",
-        "condition": lambda u: True,
-        "effect": lambda u: {"cultivation": 100, "karma": 20}
-    },
-    {
-        "name": "小溪洗礼",
-        "description": "道友在山间发现一条灵气充沛的小溪，在此修炼事半功倍。",
-        "type": "收益",
-        "condition": lambda u: True,
-        "effect": lambda u: {"cultivation": 80, "karma": 10}
-    },
-    {
-        "name": "流浪修士",
-        "description": "道友遇到一位流浪修士，互相切磋武艺，获益良多。",
-        "type": "收益",
-        "condition": lambda u: True,
-        "effect": lambda u: {"cultivation": 50, "karma": 5}
-    },
-
-    # 初级事件 - 筑基期以上可遇
-    {
-        "name": "古修士洞府",
-        "description": "道友发现了一座古老的洞府，里面留有前人的修炼心得。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 2,
-        "effect": lambda u: {"cultivation": 200, "karma": 50}
-    },
-    {
-        "name": "灵石矿脉",
-        "description": "道友探索时发现了一条灵石矿脉，收获颇丰。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 2,
-        "effect": lambda u: {"cultivation": 180, "karma": 30}
-    },
-    {
-        "name": "迷雾密林",
-        "description": "道友在一片迷雾密林中迷失方向，消耗了不少精力。",
-        "type": "损失",
-        "condition": lambda u: u.level >= 2,
-        "effect": lambda u: {"cultivation": -50, "karma": -10}
-    },
-
-    # 中级事件 - 金丹期以上可遇
-    {
-        "name": "域外天魔",
-        "description": "道友遭遇域外天魔袭击，一番苦战后才勉强逃脱。",
-        "type": "战斗",
-        "condition": lambda u: u.level >= 3,
-        "effect": lambda u: {"cultivation": -int(u.cultivation * 0.3), "karma": -50}
-    },
-    {
-        "name": "天材地宝",
-        "description": "道友有幸发现一株万年灵芝，服用后修为大涨。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 3,
-        "effect": lambda u: {"cultivation": 500, "karma": 100}
-    },
-    {
-        "name": "丹药炼制",
-        "description": "道友收集了各种灵材，成功炼制出一炉上品丹药。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 3,
-        "effect": lambda u: {"cultivation": 300, "karma": 80}
-    },
-
-    # 高级事件 - 元婴期以上可遇
-    {
-        "name": "上古遗迹",
-        "description": "道友发现了一处上古修仙门派的遗迹，获得了不少传承。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 4,
-        "effect": lambda u: {"cultivation": 800, "karma": 200, "artifacts": "古修传承玉简"}
-    },
-    {
-        "name": "灵脉争夺",
-        "description": "道友发现一条上好的灵脉，却引来其他修士的觊觎，一番争斗后侥幸守住。",
-        "type": "战斗",
-        "condition": lambda u: u.level >= 4,
-        "effect": lambda u: {"cultivation": 600, "karma": -100}
-    },
-    {
-        "name": "神秘洞天",
-        "description": "道友误入一处神秘洞天，时间流速不同，在里面修炼了数年。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 4,
-        "effect": lambda u: {"cultivation": 1000, "karma": 150}
-    },
-
-    # 特殊事件 - 化神期以上可遇
-    {
-        "name": "远古战场",
-        "description": "道友踏入一处远古仙魔战场，残留的能量波动让人心惊胆战。",
-        "type": "特殊",
-        "condition": lambda u: u.level >= 5,
-        "effect": lambda u: {"cultivation": 1500, "karma": 300, "artifacts": "破损的仙器碎片"}
-    },
-    {
-        "name": "天劫余波",
-        "description": "道友不幸被卷入他人渡劫的余波中，受到了不小的伤害。",
-        "type": "损失",
-        "condition": lambda u: u.level >= 5,
-        "effect": lambda u: {"cultivation": -int(u.cultivation * 0.4), "karma": -200}
-    },
-    {
-        "name": "秘境入口",
-        "description": "道友发现了一处通往秘境的入口，在里面获得了大量修炼资源。",
-        "type": "收益",
-        "condition": lambda u: u.level >= 5,
-        "effect": lambda u: {"cultivation": 2000, "karma": 500}
-    },
-
-    # 顶级事件 - 炼虚期以上可遇
-    {
-        "name": "飞升遗址",
-        "description": "道友发现了一位成功飞升的前辈留下的遗址，获得了关于飞升的重要线索。",
-        "type": "特殊",
-        "condition": lambda u: u.level >= 6,
-        "effect": lambda u: {"cultivation": 3000, "karma": 1000, "artifacts": "飞升玉简"}
-    },
-    {
-        "name": "天外来客",
-        "description": "道友遭遇天外来客，对方实力强大，几乎陨落。",
-        "type": "危险",
-        "condition": lambda u: u.level >= 6,
-        "effect": lambda u: {"cultivation": -int(u.cultivation * 0.5), "karma": -500}
-    },
-    {
-        "name": "悟道茶树",
-        "description": "道友有幸发现传说中的悟道茶树，品尝后顿悟己道。",
-        "type": "顿悟",
-        "condition": lambda u: u.level >= 6,
-        "effect": lambda u: {"cultivation": int(u.cultivation * 0.5), "karma": 800}
-    },
-
-    # 极限事件 - 合体期以上可遇
-    {
-        "name": "仙人洞府",
-        "description": "道友有幸闯入一位飞升仙人留下的洞府，获得了无上传承。",
-        "type": "机缘",
-        "condition": lambda u: u.level >= 7,
-        "effect": lambda u: {"cultivation": 5000, "karma": 2000, "artifacts": "仙人传承"}
-    },
-    {
-        "name": "天道惩罚",
-        "description": "道友不知何故触怒了天道，遭受天罚，差点魂飞魄散。",
-        "type": "危险",
-        "condition": lambda u: u.level >= 7,
-        "effect": lambda u: {"cultivation": -int(u.cultivation * 0.7), "karma": -1000}
-    }
-]
+from .cache import user_cache
+from .constants import REALMS
+from .cooldown import DAILY_LIMIT, cooldowns
+from .event_sink import event_sink
+from .formulas import exploration_cultivation
+from .locks import user_locks
+from .log import logger
+from .scheduler import PeriodicTask
+
+config = nonebot.get_driver().config
+
+# 插件自带的探索事件库
+BUNDLED_EVENTS_FILE = Path(__file__).parent / "exploration_events.json"
+# 探索事件库文件，修改后自动重新加载
+EVENTS_FILE = Path(
+    getattr(config, "xiuxian_events_file", None) or BUNDLED_EVENTS_FILE
+)
+# 检查事件库文件变化的间隔(秒)
+RELOAD_INTERVAL = float(getattr(config, "xiuxian_events_reload_interval", 10))
+
+# 事件效果允许的字段
+EFFECT_KEYS = {"cultivation", "cultivation_pct", "karma", "artifact"}
+
+
+class EventCatalogueError(Exception):
+    """探索事件库格式错误异常"""
+    pass
+
+
+class ExplorationEvent:
+    """编译后的探索事件"""
+
+    __slots__ = (
+        "name",
+        "description",
+        "type",
+        "min_level",
+        "weight",
+        "cultivation",
+        "cultivation_pct",
+        "karma",
+        "artifact",
+    )
+
+    def __init__(self, data: dict):
+        """
+        Args:
+            data: 事件库文件中的一条事件
+
+        Raises:
+            EventCatalogueError: 字段缺失或类型错误
+        """
+        try:
+            self.name = str(data["name"])
+            self.description = str(data["description"])
+            self.type = str(data["type"])
+        except KeyError as e:
+            raise EventCatalogueError(f"事件缺少字段 {e}") from e
+        effect = data.get("effect", {})
+        if not isinstance(effect, dict) or not set(effect) <= EFFECT_KEYS:
+            raise EventCatalogueError(f"事件「{self.name}」的 effect 格式错误")
+        self.min_level = self._number(data.get("min_level", 1), int)
+        self.weight = self._number(data.get("weight", 1), float)
+        self.cultivation = self._number(effect.get("cultivation", 0), int)
+        self.cultivation_pct = self._number(effect.get("cultivation_pct", 0), float)
+        self.karma = self._number(effect.get("karma", 0), int)
+        self.artifact = effect.get("artifact")
+        if self.min_level not in REALMS:
+            raise EventCatalogueError(f"事件「{self.name}」的 min_level 不是有效境界")
+        if self.weight <= 0:
+            raise EventCatalogueError(f"事件「{self.name}」的 weight 必须大于0")
+        if self.artifact is not None and not isinstance(self.artifact, str):
+            raise EventCatalogueError(f"事件「{self.name}」的 artifact 必须是字符串")
+
+    def _number(self, value, type_):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise EventCatalogueError(f"事件「{self.name}」存在非数值字段: {value!r}")
+        if type_ is int and value != int(value):
+            raise EventCatalogueError(f"事件「{self.name}」存在非整数字段: {value!r}")
+        return type_(value)
+
+    def available(self, level: int) -> bool:
+        """该境界是否可遇"""
+        return level >= self.min_level
+
+    def effect(self, user) -> dict:
+        """计算事件对用户的效果
+
+        Returns:
+            效果字典，键为 cultivation / karma / artifacts
+        """
+        effects = {}
+        cultivation = exploration_cultivation(
+            user.cultivation, self.cultivation, self.cultivation_pct
+        )
+        if cultivation or self.cultivation_pct:
+            effects["cultivation"] = cultivation
+        if self.karma:
+            effects["karma"] = self.karma
+        if self.artifact:
+            effects["artifacts"] = self.artifact
+        return effects
+
+
+class AliasTable:
+    """按权重抽样的别名表 (Vose alias method)，每次抽样 O(1) 且不分配内存"""
+
+    __slots__ = ("items", "_size", "_prob", "_alias")
+
+    def __init__(self, items, weights):
+        """
+        Args:
+            items: 候选项列表
+            weights: 对应的权重列表，均需大于0
+        """
+        self.items = list(items)
+        self._size = size = len(self.items)
+        self._prob = [1.0] * size
+        self._alias = list(range(size))
+        if not size:
+            return
+        total = sum(weights)
+        scaled = [w * size / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = g
+            scaled[g] -= 1.0 - scaled[s]
+            (small if scaled[g] < 1.0 else large).append(g)
+        # 剩余项因浮点误差概率视为 1
+
+    def __len__(self):
+        return self._size
+
+    def sample(self):
+        """按权重随机抽取一项，空表返回 None"""
+        if not self._size:
+            return None
+        i = int(random.random() * self._size)
+        if random.random() < self._prob[i]:
+            return self.items[i]
+        return self.items[self._alias[i]]
+
+
+def build_event_tables(events):
+    """为每个境界预先筛选可遇事件并建立抽样表
+
+    Args:
+        events: 事件列表
+
+    Returns:
+        境界等级到 AliasTable 的映射
+    """
+    tables = {}
+    for level in REALMS:
+        available = [e for e in events if e.available(level)]
+        tables[level] = AliasTable(available, [e.weight for e in available])
+    return tables
+
+
+class EventCatalogue:
+    """探索事件库，加载后只读，通过整体替换实现热更新"""
+
+    __slots__ = ("events", "tables", "mtime")
+
+    def __init__(self, events, mtime: float = 0):
+        self.events = tuple(events)
+        self.tables = build_event_tables(self.events)
+        self.mtime = mtime
+
+
+def load_catalogue(path: Path = EVENTS_FILE) -> EventCatalogue:
+    """读取并编译探索事件库
+
+    Args:
+        path: 事件库文件路径
+
+    Raises:
+        EventCatalogueError: 文件格式错误
+    """
+    mtime = path.stat().st_mtime
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except ValueError as e:
+        raise EventCatalogueError(f"事件库不是有效的JSON: {e}") from e
+    if not isinstance(data, list) or not data:
+        raise EventCatalogueError("事件库必须是非空列表")
+    events = [ExplorationEvent(item) for item in data]
+    names = [e.name for e in events]
+    if len(set(names)) != len(names):
+        raise EventCatalogueError("事件库存在重名事件")
+    return EventCatalogue(events, mtime)
+
+
+# 当前生效的事件库，启动时加载
+_catalogue = EventCatalogue([])
+_EMPTY_TABLE = AliasTable([], [])
+# 上次加载失败的文件修改时间，文件未再变化时不重复加载
+_failed_mtime = None
+
+
+def get_catalogue() -> EventCatalogue:
+    """获取当前生效的事件库"""
+    return _catalogue
+
+
+async def reload_catalogue(force: bool = False) -> bool:
+    """事件库文件有变化时在线程中重新加载并替换
+
+    Args:
+        force: 忽略修改时间强制重新加载
+
+    Returns:
+        是否完成替换
+    """
+    global _catalogue, _failed_mtime
+    try:
+        mtime = EVENTS_FILE.stat().st_mtime
+    except OSError as e:
+        logger.warning(f"无法读取探索事件库 {EVENTS_FILE}", e=e)
+        return False
+    if not force and mtime in (_catalogue.mtime, _failed_mtime):
+        return False
+    loop = asyncio.get_running_loop()
+    try:
+        catalogue = await loop.run_in_executor(None, load_catalogue, EVENTS_FILE)
+    except (OSError, EventCatalogueError) as e:
+        _failed_mtime = mtime
+        logger.error("探索事件库加载失败，继续使用旧版本", e=e)
+        return False
+    _catalogue = catalogue
+    logger.info(f"探索事件库已重新加载, 共 {len(catalogue.events)} 个事件")
+    return True
+
+
+reload_task = PeriodicTask("探索事件库热更新", RELOAD_INTERVAL, reload_catalogue)
+
+
+async def start_catalogue_reload():
+    """加载事件库并启动热更新，配置的事件库无法加载时使用自带的事件库"""
+    global _catalogue
+    if not await reload_catalogue(force=True) and EVENTS_FILE != BUNDLED_EVENTS_FILE:
+        try:
+            _catalogue = load_catalogue(BUNDLED_EVENTS_FILE)
+            logger.warning(f"已改用自带的探索事件库 {BUNDLED_EVENTS_FILE}")
+        except (OSError, EventCatalogueError) as e:
+            logger.error("自带的探索事件库加载失败", e=e)
+    reload_task.start()
+
+
+async def stop_catalogue_reload():
+    """停止事件库热更新"""
+    await reload_task.stop()
+
+
+def get_event_table(level):
+    """获取境界对应的事件抽样表"""
+    return _catalogue.tables.get(level, _EMPTY_TABLE)
 
 
 # 随机获取可用事件
@@ -178,7 +284,19 @@ def get_available_events(user):
     Returns:
         可用事件列表
     """
-    return [e for e in EXPLORATION_EVENTS if e["condition"](user)]
+    return get_event_table(user.level).items
+
+
+def pick_event(user):
+    """按权重随机抽取一个可遇事件
+
+    Args:
+        user: 修仙用户对象
+
+    Returns:
+        探索事件，没有可遇事件时返回 None
+    """
+    return get_event_table(user.level).sample()
 
 
 # 处理文字效果描述
@@ -211,35 +329,40 @@ async def handle_explore(bot: Bot, event: MessageEvent, state: T_State):
     """处理探索命令"""
     user_id = str(event.user_id)
 
-    # 获取用户数据
-    user = await XiuxianUser.get_or_none(user_id=user_id)
-    if not user:
-        await explore.finish("道友还未创建角色，请先使用「开始修仙」命令！")
-        return
-
-    # 从探索模块获取可用事件
-    available_events = get_available_events(user)
-    if not available_events:
-        await explore.finish("道友暂时没有遇到任何机缘。")
-        return
-
-    # 随机选择一个事件
-    selected_event = random.choice(available_events)
-
-    # 应用事件效果
-    result = await apply_event_effect(user, selected_event)
-
-    # 记录事件
-    await XiuxianEvent.create(
-        user=user,
-        event_type="探索",
-        event_name=result["name"],
-        exp_change=0,  # 修为变化已在apply_event_effect中处理
-        karma_change=0  # 功德变化已在apply_event_effect中处理
-    )
+    # 串行处理同一用户的命令，避免并发修改互相覆盖
+    async with user_locks.hold(user_id):
+        # 次数用完直接拒绝，不读取用户数据
+        if cooldowns.exhausted("探索", user_id, DAILY_LIMIT):
+            await explore.finish(f"道友今日已探索{DAILY_LIMIT}次，明日再来吧！")
+            return
+
+        # 获取用户数据
+        user = await user_cache.get(user_id)
+        if not user:
+            await explore.finish("道友还未创建角色，请先使用「开始修仙」命令！")
+            return
+
+        # 按境界抽取一个事件
+        selected_event = pick_event(user)
+        if not selected_event:
+            await explore.finish("道友暂时没有遇到任何机缘。")
+            return
+
+        # 应用事件效果
+        result = await apply_event_effect(user, selected_event)
+        cooldowns.consume("探索", user_id)
+
+        # 记录事件
+        await event_sink.emit(
+            user=user,
+            event_type="探索",
+            event_name=result["name"],
+            exp_change=0,  # 修为变化已在apply_event_effect中处理
+            karma_change=0  # 功德变化已在apply_event_effect中处理
+        )
 
-    # 构建结果消息
-    result_msg = f"""【{result['name']}】
+        # 构建结果消息
+        result_msg = f"""【{result['name']}】
 {result['description']}
 
 事件结果:
@@ -256,12 +379,12 @@ async def apply_event_effect(user, event):
     
     Args:
         user: 修仙用户对象
-        event: 事件数据
+        event: 探索事件
         
     Returns:
         事件效果描述
     """
-    effects = event["effect"](user)
+    effects = event.effect(user)
 
     # 处理基础属性
     for key, value in effects.items():
@@ -273,11 +396,11 @@ async def apply_event_effect(user, event):
                 user.artifacts = []
             user.artifacts.append(value)
 
-    await user.save()
+    user_cache.mark_dirty(user)
 
     # 返回效果描述
     return {
-        "name": event["name"],
-        "description": event["description"],
+        "name": event.name,
+        "description": event.description,
         "effects": get_effect_desc(effects)
     }
@@ -0,0 +1,89 @@
+"""
+数值公式
+作者: biupiaa
+"""
+
+# 本模块不依赖插件的其他模块，参数既可以是普通数值，也可以是 NumPy 数组，
+# 插件处理器和离线平衡模拟 (scripts/simulate.py) 共用同一套公式。
+
+# 修炼收益的随机波动幅度
+CULTIVATION_NOISE = 0.2
+# 可以渡劫的最高境界，达到后不再渡劫
+MAX_TRIBULATION_LEVEL = 8
+# 渡劫失败损失的修为比例
+TRIBULATION_FAIL_LOSS = 0.5
+# 渡劫成功和失败记录的功德变化
+TRIBULATION_KARMA = (50, -30)
+# PK 胜率上下限与胜负双方的功德变化
+PK_MIN_WIN_RATE = 0.2
+PK_MAX_WIN_RATE = 0.8
+PK_KARMA = 20
+
+
+def cultivation_gain(level, coefficient, noise):
+    """单次修炼获得的修为
+
+    Args:
+        level: 境界
+        coefficient: 灵根系数，见 ELEMENT_COEFFICIENTS
+        noise: [-CULTIVATION_NOISE, CULTIVATION_NOISE] 内的随机波动
+    """
+    return _trunc(level * (1 + coefficient) * (1 + noise))
+
+
+def breakthrough_cultivation(level):
+    """突破到某境界所需的修为"""
+    return level * 1000
+
+
+def tribulation_success_rate(level):
+    """当前境界渡劫的成功率，境界越高越低"""
+    return 0.8 - level * 0.05
+
+
+def tribulation_loss(required):
+    """渡劫失败损失的修为
+
+    Args:
+        required: 渡劫所需修为
+    """
+    return _trunc(required * TRIBULATION_FAIL_LOSS)
+
+
+def exploration_cultivation(cultivation, flat, pct):
+    """探索事件的修为变化：固定值加当前修为的比例"""
+    return flat + _trunc(cultivation * pct)
+
+
+def pk_win_rate(power, other_power):
+    """按双方战斗力计算胜率，限制在上下限之间"""
+    rate = 0.5 + (power - other_power) / (power + other_power) * 0.3
+    return _clip(rate, PK_MIN_WIN_RATE, PK_MAX_WIN_RATE)
+
+
+def pk_exp_reward(level, other_level):
+    """PK 胜者获得的修为，按双方较低的境界计算"""
+    return _minimum(level, other_level) * 100
+
+
+def combat_power(cultivation, level, element_bonus, artifact_count):
+    """战斗力 = 修为 + 境界加成 + 灵根加成 + 法宝加成"""
+    return cultivation + level * 500 + element_bonus + artifact_count * 200
+
+
+def _trunc(value):
+    """向零取整"""
+    if hasattr(value, "astype"):
+        return value.astype("int64")
+    return int(value)
+
+
+def _clip(value, low, high):
+    if hasattr(value, "clip"):
+        return value.clip(low, high)
+    return max(low, min(high, value))
+
+
+def _minimum(a, b):
+    # 比较结果在 Python 中为 bool、在 NumPy 中为数组，乘法对两者都适用
+    return b + (a - b) * (a < b)
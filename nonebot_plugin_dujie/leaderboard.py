@@ -0,0 +1,110 @@
+"""
+战力排行榜
+作者: biupiaa
+"""
+
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+import nonebot
+from nonebot import on_command
+from nonebot.adapters.onebot.v11 import Bot, MessageEvent
+from nonebot.typing import T_State
+from sortedcontainers import SortedList
+
+from .log import logger
+from .models import XiuxianUser
+
+config = nonebot.get_driver().config
+
+# 排行榜展示人数
+TOP_N = int(getattr(config, "xiuxian_rank_top_n", 10))
+
+
+class Leaderboard:
+    """按战斗力排序的内存排行榜
+
+    启动时从数据库加载一次，之后随用户数据写入同步更新，
+    前N名与个人排名查询均为 O(log n)。
+    """
+
+    def __init__(self):
+        # (-战斗力, user_id)，战力相同按QQ号排序
+        self._entries = SortedList()
+        self._powers: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def load(self):
+        """从主库加载全部用户战斗力
+
+        之后只随用户数据写入增量更新，不能读取可能有复制延迟的只读连接。
+        """
+        rows = await XiuxianUser.all().values_list("user_id", "combat_power")
+        self._powers = dict(rows)
+        self._entries = SortedList((-power, user_id) for user_id, power in rows)
+        logger.info(f"战力排行榜加载完成, 共 {len(self._entries)} 位道友")
+
+    def update(self, user_id: str, power: int):
+        """更新用户战斗力"""
+        old = self._powers.get(user_id)
+        if old == power:
+            return
+        if old is not None:
+            self._entries.remove((-old, user_id))
+        self._entries.add((-power, user_id))
+        self._powers[user_id] = power
+
+    def rank(self, user_id: str) -> Optional[int]:
+        """获取用户排名（从1开始），不在榜上返回 None"""
+        power = self._powers.get(user_id)
+        if power is None:
+            return None
+        return self._entries.index((-power, user_id)) + 1
+
+    def power(self, user_id: str) -> Optional[int]:
+        """获取榜上记录的战斗力"""
+        return self._powers.get(user_id)
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """获取前n名
+
+        Returns:
+            [(QQ号, 战斗力), ...]
+        """
+        return [(user_id, -power) for power, user_id in islice(self._entries, n)]
+
+
+leaderboard = Leaderboard()
+
+
+async def load_leaderboard():
+    """启动时加载排行榜"""
+    await leaderboard.load()
+
+
+# 排行榜命令
+rank = on_command("修仙排行", aliases={"战力排行"}, priority=5, block=True)
+
+@rank.handle()
+async def handle_rank(bot: Bot, event: MessageEvent, state: T_State):
+    """处理排行榜命令"""
+    user_id = str(event.user_id)
+
+    top = leaderboard.top(TOP_N)
+    if not top:
+        await rank.finish("还没有道友踏上修仙之路！")
+        return
+
+    result = "===== 战力排行 =====\n"
+    for i, (top_user_id, power) in enumerate(top, 1):
+        result += f"{i}. {top_user_id} 战力: {power}\n"
+
+    my_rank = leaderboard.rank(user_id)
+    if my_rank is None:
+        result += "\n道友还未创建角色，请先使用「开始修仙」命令！"
+    else:
+        result += f"\n道友当前排名: 第{my_rank}名 (战力: {leaderboard.power(user_id)})"
+
+    await rank.finish(result)
@@ -0,0 +1,69 @@
+"""
+用户级命令串行化
+作者: biupiaa
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+
+class KeyedLocks:
+    """按键分配的 asyncio 锁
+
+    同一个键的操作串行执行，不同键互不影响。锁只在有人持有或等待时存在，
+    空闲后立即回收，内存占用与并发中的键数成正比。
+    """
+
+    def __init__(self):
+        # key -> [锁, 持有及等待数]
+        self._locks: Dict[str, List] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, *keys: str):
+        """同时持有多个键的锁
+
+        多个键按固定顺序加锁，避免两方操作互相等待造成死锁。
+        同一调用链中只应调用一次 hold，不要嵌套获取。
+
+        Args:
+            keys: 需要加锁的键
+        """
+        keys = sorted(set(keys))
+        locks = [self._ref(key) for key in keys]
+        locked = 0
+        try:
+            for lock in locks:
+                await lock.acquire()
+                locked += 1
+            yield
+        finally:
+            for i, key in enumerate(keys):
+                if i < locked:
+                    locks[i].release()
+                self._unref(key)
+
+    def _ref(self, key: str) -> asyncio.Lock:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _unref(self, key: str):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+
+def sect_key(sect_id: int) -> str:
+    """门派锁的键"""
+    return f"sect:{sect_id}"
+
+
+# 用户与门派共用的锁表，用户以QQ号为键，门派使用 sect_key
+user_locks = KeyedLocks()
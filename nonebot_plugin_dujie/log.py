@@ -1,38 +1,95 @@
+from __future__ import annotations
+
+import sys
 from datetime import datetime, timedelta
-from typing import Any, overload
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, overload
 
 import nonebot
-from nonebot import require
-
-require("nonebot_plugin_session")
 from loguru import logger as logger_
 from nonebot.log import default_filter, default_format
-from nonebot_plugin_session import Session
-from nonebot_plugin_uninfo import Session as uninfoSession
 
-from zhenxun.configs.path_config import LOG_PATH
+if TYPE_CHECKING:
+    from nonebot_plugin_session import Session
+    from nonebot_plugin_uninfo import Session as uninfoSession
+
+# 日志目录：优先使用配置，其次是真寻的日志目录，都没有时写到当前目录的 log 下
+try:
+    from zhenxun.configs.path_config import LOG_PATH
+except ImportError:
+    LOG_PATH = Path("log")
 
 driver = nonebot.get_driver()
 
 log_level = driver.config.log_level or "INFO"
 
-logger_.add(
-    LOG_PATH / f"{datetime.now().date()}.log",
-    level=log_level,
-    rotation="00:00",
-    format=default_format,
-    filter=default_filter,
-    retention=timedelta(days=30),
-)
+LOG_PATH = Path(getattr(driver.config, "xiuxian_log_path", None) or LOG_PATH)
+
+# 额外按天写入 JSON 格式日志，会话信息在 record.extra 中，便于日志系统采集
+LOG_JSON = bool(getattr(driver.config, "xiuxian_log_json", False))
+
+_sinks_added = False
+
+
+def setup_log_sinks():
+    """添加日志文件输出，在启动时调用，重复调用不会重复添加
+
+    文件输出使用 enqueue，由后台线程写盘，不阻塞事件循环；
+    退出时 loguru 会移除输出并写完队列中剩余的日志
+    """
+    global _sinks_added
+    if _sinks_added:
+        return
+    _sinks_added = True
+    date = datetime.now().date()
+    logger_.add(
+        LOG_PATH / f"{date}.log",
+        level=log_level,
+        rotation="00:00",
+        format=default_format,
+        filter=default_filter,
+        retention=timedelta(days=30),
+        enqueue=True,
+    )
+    logger_.add(
+        LOG_PATH / f"error_{date}.log",
+        level="ERROR",
+        rotation="00:00",
+        format=default_format,
+        filter=default_filter,
+        retention=timedelta(days=30),
+        enqueue=True,
+    )
+    if LOG_JSON:
+        logger_.add(
+            LOG_PATH / f"{date}.json",
+            level=log_level,
+            rotation="00:00",
+            filter=default_filter,
+            retention=timedelta(days=30),
+            serialize=True,
+            enqueue=True,
+        )
+
+
+def _session_class(module: str):
+    """取会话插件的 Session 类
+
+    会话插件是可选依赖，不主动导入：调用方传入其 Session 对象时
+    模块必然已经加载，未加载时返回 None
+    """
+    return getattr(sys.modules.get(module), "Session", None)
+
 
-logger_.add(
-    LOG_PATH / f"error_{datetime.now().date()}.log",
-    level="ERROR",
-    rotation="00:00",
-    format=default_format,
-    filter=default_filter,
-    retention=timedelta(days=30),
+# 各输出都经过 default_filter，低于 log_level 的日志不会被输出，
+# 在解析会话和拼接模板之前直接返回
+_MIN_LEVEL_NO = (
+    logger_.level(log_level).no if isinstance(log_level, str) else int(log_level)
 )
+_LEVEL_NO = {
+    name: logger_.level(name).no
+    for name in ("DEBUG", "INFO", "SUCCESS", "WARNING", "ERROR")
+}
 
 
 class logger:
@@ -107,28 +164,11 @@ class logger:
         target: Any = None,
         platform: str | None = None,
     ):
-        user_id: str | None = session  # type: ignore
-        if isinstance(session, Session):
-            user_id = session.id1
-            adapter = session.bot_type
-            if session.id3:
-                group_id = f"{session.id3}:{session.id2}"
-            elif session.id2:
-                group_id = f"{session.id2}"
-            platform = platform or session.platform
-        elif isinstance(session, uninfoSession):
-            user_id = session.user.id
-            adapter = session.adapter
-            if session.group:
-                group_id = session.group.id
-            platform = session.basic["scope"]
-        template = cls.__parser_template(
-            info, command, user_id, group_id, adapter, target, platform
+        if _LEVEL_NO["INFO"] < _MIN_LEVEL_NO:
+            return
+        cls.__log(
+            "INFO", info, command, session, group_id, adapter, target, platform
         )
-        try:
-            logger_.opt(colors=True).info(template)
-        except Exception:
-            logger_.info(template)
 
     @classmethod
     def success(
@@ -138,6 +178,8 @@ class logger:
         param: dict[str, Any] | None = None,
         result: str = "",
     ):
+        if _LEVEL_NO["SUCCESS"] < _MIN_LEVEL_NO:
+            return
         param_str = ""
         if param:
             param_str = ",".join([f"<m>{k}</m>:<g>{v}</g>" for k, v in param.items()])
@@ -201,30 +243,12 @@ class logger:
         platform: str | None = None,
         e: Exception | None = None,
     ):
-        user_id: str | None = session  # type: ignore
-        if isinstance(session, Session):
-            user_id = session.id1
-            adapter = session.bot_type
-            if session.id3:
-                group_id = f"{session.id3}:{session.id2}"
-            elif session.id2:
-                group_id = f"{session.id2}"
-            platform = platform or session.platform
-        elif isinstance(session, uninfoSession):
-            user_id = session.user.id
-            adapter = session.adapter
-            if session.group:
-                group_id = session.group.id
-            platform = session.basic["scope"]
-        template = cls.__parser_template(
-            info, command, user_id, group_id, adapter, target, platform
+        if _LEVEL_NO["WARNING"] < _MIN_LEVEL_NO:
+            return
+        error = f" || 错误<r>{type(e)}: {e}</r>" if e else ""
+        cls.__log(
+            "WARNING", info, command, session, group_id, adapter, target, platform, error
         )
-        if e:
-            template += f" || 错误<r>{type(e)}: {e}</r>"
-        try:
-            logger_.opt(colors=True).warning(template)
-        except Exception as e:
-            logger_.warning(template)
 
     @overload
     @classmethod
@@ -280,30 +304,12 @@ class logger:
         platform: str | None = None,
         e: Exception | None = None,
     ):
-        user_id: str | None = session  # type: ignore
-        if isinstance(session, Session):
-            user_id = session.id1
-            adapter = session.bot_type
-            if session.id3:
-                group_id = f"{session.id3}:{session.id2}"
-            elif session.id2:
-                group_id = f"{session.id2}"
-            platform = platform or session.platform
-        elif isinstance(session, uninfoSession):
-            user_id = session.user.id
-            adapter = session.adapter
-            if session.group:
-                group_id = session.group.id
-            platform = session.basic["scope"]
-        template = cls.__parser_template(
-            info, command, user_id, group_id, adapter, target, platform
+        if _LEVEL_NO["ERROR"] < _MIN_LEVEL_NO:
+            return
+        error = f" || 错误 <r>{type(e)}: {e}</r>" if e else ""
+        cls.__log(
+            "ERROR", info, command, session, group_id, adapter, target, platform, error
         )
-        if e:
-            template += f" || 错误 <r>{type(e)}: {e}</r>"
-        try:
-            logger_.opt(colors=True).error(template)
-        except Exception as e:
-            logger_.error(template)
 
     @overload
     @classmethod
@@ -358,9 +364,36 @@ class logger:
         target: Any = None,
         platform: str | None = None,
         e: Exception | None = None,
+    ):
+        if _LEVEL_NO["DEBUG"] < _MIN_LEVEL_NO:
+            return
+        error = f" || 错误 <r>{type(e)}: {e}</r>" if e else ""
+        cls.__log(
+            "DEBUG", info, command, session, group_id, adapter, target, platform, error
+        )
+
+    @classmethod
+    def enabled(cls, level: str) -> bool:
+        """该等级的日志是否会被输出，拼接开销较大的日志前可先判断"""
+        return _LEVEL_NO[level] >= _MIN_LEVEL_NO
+
+    @classmethod
+    def __log(
+        cls,
+        level: str,
+        info: str,
+        command: str | None,
+        session: int | str | Session | uninfoSession | None,
+        group_id: int | str | None,
+        adapter: str | None,
+        target: Any,
+        platform: str | None,
+        error: str = "",
     ):
         user_id: str | None = session  # type: ignore
-        if isinstance(session, Session):
+        session_class = _session_class("nonebot_plugin_session")
+        uninfo_class = _session_class("nonebot_plugin_uninfo")
+        if session_class is not None and isinstance(session, session_class):
             user_id = session.id1
             adapter = session.bot_type
             if session.id3:
@@ -368,7 +401,7 @@ class logger:
             elif session.id2:
                 group_id = f"{session.id2}"
             platform = platform or session.platform
-        elif isinstance(session, uninfoSession):
+        elif uninfo_class is not None and isinstance(session, uninfo_class):
             user_id = session.user.id
             adapter = session.adapter
             if session.group:
@@ -377,12 +410,20 @@ class logger:
         template = cls.__parser_template(
             info, command, user_id, group_id, adapter, target, platform
         )
-        if e:
-            template += f" || 错误 <r>{type(e)}: {e}</r>"
+        template += error
+        log = logger_
+        if LOG_JSON:
+            log = logger_.bind(
+                user_id=user_id,
+                group_id=group_id,
+                command=command,
+                adapter=adapter,
+                platform=platform,
+            )
         try:
-            logger_.opt(colors=True).debug(template)
-        except Exception as e:
-            logger_.debug(template)
+            log.opt(colors=True).log(level, template)
+        except Exception:
+            log.log(level, template)
 
     @classmethod
     def __parser_template(
@@ -0,0 +1,295 @@
+"""
+命令耗时统计模块
+作者: biupiaa
+"""
+
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, List, Optional
+
+import nonebot
+from nonebot import on_command
+from nonebot.adapters.onebot.v11 import Bot, MessageEvent
+from nonebot.matcher import Matcher, current_matcher
+from nonebot.message import run_postprocessor, run_preprocessor
+from nonebot.permission import SUPERUSER
+from nonebot.rule import CommandRule
+from nonebot.typing import T_State
+from tortoise import Tortoise
+
+from .log import logger
+from .scheduler import PeriodicTask
+
+config = nonebot.get_driver().config
+
+# 是否统计命令耗时，关闭时不注册任何钩子
+METRICS_ENABLED = bool(getattr(config, "xiuxian_metrics", False))
+# 定时输出统计到日志的间隔(秒)，0表示不输出
+METRICS_LOG_INTERVAL = float(getattr(config, "xiuxian_metrics_log_interval", 0))
+
+# 直方图分桶上界(毫秒)
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# 计时的数据库客户端方法
+QUERY_METHODS = (
+    "execute_insert",
+    "execute_many",
+    "execute_query",
+    "execute_query_dict",
+    "execute_script",
+)
+
+
+class Histogram:
+    """固定分桶的耗时直方图，分位数取所在桶的上界"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """估算分位数，超出最大分桶时返回最大值"""
+        n = sum(self.counts)
+        if not n:
+            return 0.0
+        rank = q * n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+
+class CommandStats:
+    """单个命令的累计统计"""
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.wall = Histogram()
+        self.db = Histogram()
+        self.queries = 0
+        self.max_queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # 没有读取数据库、所需数据全部来自缓存的次数
+        self.cached_runs = 0
+
+
+class Sample:
+    """一次命令执行中的计数"""
+
+    __slots__ = ("started", "queries", "db_time", "hits", "misses", "depth")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.depth = 0
+
+
+class CommandMetrics:
+    """按命令统计耗时、数据库查询和缓存命中
+
+    运行前处理钩子为每个匹配器开始计数，数据库客户端的执行方法
+    和用户缓存通过 current_matcher 找到当前命令并累加，
+    运行后处理钩子把结果计入该命令的直方图。只统计处理器内发生的查询，
+    后台回写等任务不计入。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stats: Dict[str, CommandStats] = {}
+        self.since = time.time()
+        # 匹配器实例 id -> 正在执行的计数
+        self._active: Dict[int, Sample] = {}
+        # 匹配器类型 -> 展示名
+        self._names: Dict[type, str] = {}
+
+    def begin(self, matcher: Matcher):
+        # 其他插件的运行前处理钩子跳过匹配器时不会执行运行后处理，
+        # 残留的计数在积累过多时丢弃
+        if len(self._active) > 1000:
+            self._active.clear()
+        self._active[id(matcher)] = Sample()
+
+    def end(self, matcher: Matcher, exception: Optional[Exception]):
+        sample = self._active.pop(id(matcher), None)
+        if sample is None:
+            return
+        name = self._name(type(matcher))
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = CommandStats()
+        stats.runs += 1
+        if exception is not None:
+            stats.errors += 1
+        stats.wall.observe((time.perf_counter() - sample.started) * 1000)
+        stats.db.observe(sample.db_time * 1000)
+        stats.queries += sample.queries
+        stats.max_queries = max(stats.max_queries, sample.queries)
+        stats.cache_hits += sample.hits
+        stats.cache_misses += sample.misses
+        if not sample.queries:
+            stats.cached_runs += 1
+
+    def cache_access(self, hit: bool):
+        """记录一次用户缓存访问"""
+        sample = self._current()
+        if sample is None:
+            return
+        if hit:
+            sample.hits += 1
+        else:
+            sample.misses += 1
+
+    def instrument(self):
+        """为数据库客户端及其事务类的执行方法加上计时"""
+        client_class = type(Tortoise.get_connection("default"))
+        classes = [client_class]
+        for cls in classes:
+            classes.extend(cls.__subclasses__())
+            for name in QUERY_METHODS:
+                func = cls.__dict__.get(name)
+                if func is not None and not getattr(func, "_metrics_wrapped", False):
+                    setattr(cls, name, self._timed(func))
+
+    def summary(self) -> List[str]:
+        """各命令的统计，按总耗时从高到低排列"""
+        lines = []
+        ordered = sorted(
+            self.stats.items(), key=lambda item: item[1].wall.total, reverse=True
+        )
+        for name, s in ordered:
+            accesses = s.cache_hits + s.cache_misses
+            hit_rate = f"{s.cache_hits / accesses:.0%}" if accesses else "-"
+            lines.append(
+                f"{name}: {s.runs}次 错误{s.errors} "
+                f"耗时 p50≤{s.wall.quantile(0.5):.1f}ms "
+                f"p95≤{s.wall.quantile(0.95):.1f}ms max {s.wall.max:.1f}ms | "
+                f"数据库 平均{s.db.total / s.runs:.1f}ms "
+                f"p95≤{s.db.quantile(0.95):.1f}ms | 查询 平均{s.queries / s.runs:.1f} "
+                f"最多{s.max_queries} | 缓存命中 {hit_rate} "
+                f"免查询 {s.cached_runs / s.runs:.0%}"
+            )
+        return lines
+
+    def reset(self):
+        self.stats.clear()
+        self.since = time.time()
+
+    def _current(self) -> Optional[Sample]:
+        matcher = current_matcher.get(None)
+        if matcher is None:
+            return None
+        return self._active.get(id(matcher))
+
+    def _timed(self, func):
+        metrics = self
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            sample = metrics._current()
+            # 只统计最外层调用，避免后端内部互相调用时重复计数
+            if sample is None or sample.depth:
+                return await func(*args, **kwargs)
+            sample.depth += 1
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                sample.depth -= 1
+                sample.queries += 1
+                sample.db_time += time.perf_counter() - started
+
+        wrapper._metrics_wrapped = True
+        return wrapper
+
+    def _name(self, matcher_type: type) -> str:
+        """命令匹配器取命令名（有别名时取排序最前的一个），其他匹配器取模块名"""
+        name = self._names.get(matcher_type)
+        if name is None:
+            name = matcher_type.module_name or "unknown"
+            for checker in matcher_type.rule.checkers:
+                if isinstance(checker.call, CommandRule):
+                    name = "".join(min(checker.call.cmds))
+                    break
+            self._names[matcher_type] = name
+        return name
+
+
+metrics = CommandMetrics()
+
+
+async def log_metrics():
+    """把统计写入日志"""
+    lines = metrics.summary()
+    if lines:
+        logger.info("命令耗时统计:\n" + "\n".join(lines))
+
+
+log_task = PeriodicTask("命令耗时统计", METRICS_LOG_INTERVAL, log_metrics)
+
+
+if METRICS_ENABLED:
+
+    @run_preprocessor
+    async def _begin_sample(matcher: Matcher):
+        metrics.begin(matcher)
+
+    @run_postprocessor
+    async def _end_sample(matcher: Matcher, exception: Optional[Exception]):
+        metrics.end(matcher, exception)
+
+
+async def start_metrics():
+    """开启统计时为数据库客户端加上计时并启动定时输出"""
+    if not METRICS_ENABLED:
+        return
+    metrics.instrument()
+    metrics.enabled = True
+    metrics.reset()
+    if METRICS_LOG_INTERVAL > 0:
+        log_task.start()
+
+
+async def stop_metrics():
+    """停止定时输出，并把最终统计写入日志"""
+    if not metrics.enabled:
+        return
+    await log_task.stop()
+    await log_metrics()
+
+
+# 查看统计命令（超级用户）
+metrics_command = on_command(
+    "修仙统计", permission=SUPERUSER, priority=5, block=True
+)
+
+@metrics_command.handle()
+async def handle_metrics(bot: Bot, event: MessageEvent, state: T_State):
+    """处理查看统计命令，带「重置」参数时清空统计"""
+    if not metrics.enabled:
+        await metrics_command.finish("未开启命令耗时统计，请配置 XIUXIAN_METRICS=true")
+        return
+
+    lines = metrics.summary()
+    since = time.strftime("%m-%d %H:%M", time.localtime(metrics.since))
+    if "重置" in event.get_plaintext():
+        metrics.reset()
+    if not lines:
+        await metrics_command.finish(f"自 {since} 以来还没有命令执行记录")
+        return
+    await metrics_command.finish(
+        f"===== 命令耗时统计（自 {since}）=====\n" + "\n".join(lines)
+    )
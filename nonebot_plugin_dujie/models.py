@@ -3,8 +3,13 @@
 作者: biupiaa
 """
 
-from tortoise import fields
-from .database import Model
+from tortoise import Tortoise, fields
+from tortoise.functions import Count, Sum
+
+from .constants import ELEMENT_POWER_BONUS
+from .database import Model, create_index_sql
+from .formulas import combat_power
+from .render_cache import render_cache, sect_info_key
 
 
 class XiuxianUser(Model):
@@ -18,13 +23,16 @@ class XiuxianUser(Model):
     karma = fields.IntField(default=0)  # 功德
     artifacts = fields.JSONField(default=list)  # 法宝列表
     last_cultivation_time = fields.FloatField(default=0)  # 上次修炼时间
+    seclusion_start = fields.FloatField(default=0)  # 闭关开始时间，0表示未闭关
     sect_id = fields.IntField(default=0, null=True)  # 门派ID，0表示无门派
+    combat_power = fields.IntField(default=0)  # 战斗力，写入时由属性计算
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
 
     class Meta:
         table = "xiuxian_users"
         table_description = "修仙用户数据表"
+        indexes = (("sect_id",),)
 
     def __str__(self):
         return f"用户{self.user_id} - {self.get_realm_name()}"
@@ -43,25 +51,68 @@ class XiuxianUser(Model):
         }
         return REALMS.get(self.level, "未知境界")
 
-    async def get_combat_power(self) -> int:
-        """获取战斗力"""
-        # 基础战力 = 修为 + 境界加成 + 灵根加成 + 法宝加成
-        base_power = self.cultivation
-        level_bonus = self.level * 500
-        element_bonus = {
-            "金": 300,
-            "木": 200,
-            "水": 250,
-            "火": 350,
-            "土": 150
-        }.get(self.element, 0)
-        
+    def calc_combat_power(self) -> int:
+        """根据当前属性计算战斗力"""
         # 处理法宝列表
         artifact_list = self.artifacts if isinstance(self.artifacts, list) else []
-        artifact_bonus = len(artifact_list) * 200
-        
-        return base_power + level_bonus + element_bonus + artifact_bonus
+        return combat_power(
+            self.cultivation,
+            self.level,
+            ELEMENT_POWER_BONUS.get(self.element, 0),
+            len(artifact_list),
+        )
+
+    def refresh_combat_power(self):
+        """同步战斗力字段"""
+        self.combat_power = self.calc_combat_power()
+
+    async def get_combat_power(self) -> int:
+        """获取战斗力"""
+        return self.calc_combat_power()
+
+    async def save(self, *args, **kwargs):
+        self.refresh_combat_power()
+        await super().save(*args, **kwargs)
+
+    @classmethod
+    async def _run_script(cls):
+        # 旧库补充战斗力字段，并按与 calc_combat_power 相同的公式回填
+        json_length = {
+            "sqlite": "json_array_length(artifacts)",
+            "mysql": "JSON_LENGTH(artifacts)",
+            "postgres": "jsonb_array_length(artifacts::jsonb)",
+        }.get(Tortoise.get_connection("default").capabilities.dialect, "0")
+        element_bonus = " ".join(
+            f"WHEN '{element}' THEN {bonus}"
+            for element, bonus in ELEMENT_POWER_BONUS.items()
+        )
+        return [
+            (
+                "xiuxian_users_0001_combat_power",
+                "ALTER TABLE xiuxian_users ADD COLUMN combat_power INT NOT NULL DEFAULT 0;",
+            ),
+            (
+                "xiuxian_users_0002_combat_power_backfill",
+                "UPDATE xiuxian_users SET combat_power = cultivation + level * 500"
+                f" + CASE element {element_bonus} ELSE 0 END + {json_length} * 200"
+                " WHERE combat_power = 0;",
+            ),
+            (
+                "xiuxian_users_0003_sect_index",
+                create_index_sql(cls, ["sect_id"]),
+            ),
+            (
+                "xiuxian_users_0004_seclusion_start",
+                "ALTER TABLE xiuxian_users ADD COLUMN seclusion_start"
+                " DOUBLE PRECISION NOT NULL DEFAULT 0;",
+            ),
+        ]
     
+    @property
+    def is_secluded(self) -> bool:
+        """是否正在闭关"""
+        return bool(self.seclusion_start)
+
     @property
     def has_sect(self) -> bool:
         """是否加入门派"""
@@ -85,11 +136,59 @@ class XiuxianEvent(Model):
     class Meta:
         table = "xiuxian_events"
         table_description = "修仙事件记录表"
+        indexes = (("user_id", "created_at"), ("created_at",))
+
+    @classmethod
+    async def _run_script(cls):
+        return [
+            (
+                "xiuxian_events_0001_user_time_index",
+                create_index_sql(cls, ["user_id", "created_at"]),
+            ),
+            (
+                "xiuxian_events_0002_time_index",
+                create_index_sql(cls, ["created_at"]),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.user_id}的{self.event_type}事件 - {self.event_name}"
 
 
+class XiuxianEventDaily(Model):
+    """修仙事件每日汇总模型，由过期的事件记录归档而来"""
+    id = fields.IntField(pk=True)
+    user = fields.ForeignKeyField('models.XiuxianUser', related_name='daily_events')
+    day = fields.DateField()  # 日期
+    event_type = fields.CharField(max_length=20)  # 事件类型
+    count = fields.IntField(default=0)  # 事件次数
+    exp_change = fields.IntField(default=0)  # 经验变化合计
+    karma_change = fields.IntField(default=0)  # 功德变化合计
+
+    class Meta:
+        table = "xiuxian_event_daily"
+        table_description = "修仙事件每日汇总表"
+        unique_together = (("user", "day", "event_type"),)
+
+    def __str__(self):
+        return f"{self.user_id}在{self.day}的{self.event_type}事件 x{self.count}"
+
+
+class XiuxianCooldown(Model):
+    """命令冷却与每日次数模型"""
+    key = fields.CharField(max_length=50, pk=True)  # 命令:用户QQ号
+    deadline = fields.FloatField(default=0)  # 冷却结束时间戳
+    day = fields.DateField(null=True)  # 次数对应的日期
+    count = fields.IntField(default=0)  # 当日使用次数
+
+    class Meta:
+        table = "xiuxian_cooldowns"
+        table_description = "命令冷却与每日次数表"
+
+    def __str__(self):
+        return f"{self.key} 冷却至 {self.deadline}, {self.day} 已用 {self.count} 次"
+
+
 class Sect(Model):
     """门派模型"""
     id = fields.IntField(pk=True)
@@ -99,6 +198,8 @@ class Sect(Model):
     level = fields.IntField(default=1)  # 门派等级
     resources = fields.IntField(default=0)  # 门派资源
     elders = fields.JSONField(default=list)  # 长老列表
+    member_count = fields.IntField(default=0)  # 成员数，随成员变动增量维护
+    total_power = fields.IntField(default=0)  # 门派总战力，随成员变动增量维护
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
 
@@ -109,16 +210,47 @@ class Sect(Model):
     def __str__(self):
         return f"门派: {self.name} (等级: {self.level})"
 
+    async def save(self, *args, **kwargs):
+        await super().save(*args, **kwargs)
+        render_cache.bump(sect_info_key(self.id))
+
+    @classmethod
+    async def _run_script(cls):
+        # 旧库补充统计字段，数值由启动时的校准任务填充
+        return [
+            (
+                "xiuxian_sects_0001_member_count",
+                "ALTER TABLE xiuxian_sects ADD COLUMN member_count INT NOT NULL DEFAULT 0;",
+            ),
+            (
+                "xiuxian_sects_0002_total_power",
+                "ALTER TABLE xiuxian_sects ADD COLUMN total_power INT NOT NULL DEFAULT 0;",
+            ),
+        ]
+
     async def get_members(self):
         """获取所有成员"""
         return await XiuxianUser.filter(sect_id=self.id)
     
+    async def get_stats(self):
+        """统计门派成员数和总战力
+
+        Returns:
+            (成员数, 总战力)
+        """
+        row = await (
+            XiuxianUser.filter(sect_id=self.id)
+            .annotate(member_count=Count("id"), total_power=Sum("combat_power"))
+            .first()
+            .values("member_count", "total_power")
+        )
+        if not row:
+            return 0, 0
+        return row["member_count"] or 0, row["total_power"] or 0
+
     async def get_total_power(self):
         """计算门派总战力"""
-        members = await self.get_members()
-        total_power = 0
-        for member in members:
-            total_power += await member.get_combat_power()
+        _, total_power = await self.get_stats()
         return total_power
         
     def add_elder(self, elder_id):
@@ -160,6 +292,23 @@ class PkRecord(Model):
     class Meta:
         table = "xiuxian_pk_records"
         table_description = "修仙PK记录表"
+        indexes = (
+            ("challenger_id", "created_at"),
+            ("defender_id", "created_at"),
+        )
+
+    @classmethod
+    async def _run_script(cls):
+        return [
+            (
+                "xiuxian_pk_records_0001_challenger_index",
+                create_index_sql(cls, ["challenger_id", "created_at"]),
+            ),
+            (
+                "xiuxian_pk_records_0002_defender_index",
+                create_index_sql(cls, ["defender_id", "created_at"]),
+            ),
+        ]
 
     def __str__(self):
         if self.is_sect_pk:
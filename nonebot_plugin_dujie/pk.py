@@ -9,8 +9,24 @@ from nonebot import on_command
 from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent, Message, MessageEvent
 from nonebot.params import CommandArg
 from nonebot.typing import T_State
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
 
-from .models import XiuxianUser, XiuxianEvent, PkRecord
+from .cache import user_cache
+from .cooldown import PK_CD, cooldowns
+from .database import bulk_update_rows
+from .formulas import PK_KARMA, pk_exp_reward, pk_win_rate
+from .locks import user_locks
+from .models import XiuxianUser, XiuxianEvent, PkRecord, Sect
+from .render_cache import render_cache, sect_info_key
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 门派战每批插入的PK记录条数
+SECT_PK_RECORD_BATCH_SIZE = 500
 
 # PK命令
 pk_command = on_command("修仙PK", aliases={"修仙pk", "道友PK", "道友pk"}, priority=5, block=True)
@@ -27,8 +43,14 @@ async def handle_pk(bot: Bot, event: MessageEvent, state: T_State, args: Message
     
     group_id = str(event.group_id)
     
+    # 冷却中直接拒绝，不读取用户数据
+    remaining_time = cooldowns.remaining("修仙PK", user_id)
+    if remaining_time:
+        await pk_command.finish(f"道友刚经历一场大战，{remaining_time}秒后才能再次PK。")
+        return
+    
     # 获取挑战者信息
-    challenger = await XiuxianUser.get_or_none(user_id=user_id)
+    challenger = await user_cache.get(user_id)
     if not challenger:
         await pk_command.finish("道友还未创建角色，请先使用「开始修仙」命令！")
         return
@@ -45,77 +67,92 @@ async def handle_pk(bot: Bot, event: MessageEvent, state: T_State, args: Message
         return
     
     # 获取目标用户信息
-    defender = await XiuxianUser.get_or_none(user_id=target_id)
+    defender = await user_cache.get(target_id)
     if not defender:
         await pk_command.finish("目标道友尚未踏上修仙之路！")
         return
     
-    # 计算战斗力
-    challenger_power = await challenger.get_combat_power()
-    defender_power = await defender.get_combat_power()
-    
-    # 计算胜率
-    win_rate = 0.5 + (challenger_power - defender_power) / (challenger_power + defender_power) * 0.3
-    win_rate = max(0.2, min(0.8, win_rate))  # 保证胜率在20%-80%之间
-    
-    # 随机决定胜负
-    challenger_wins = random.random() < win_rate
-    
-    # 战斗结果
-    winner_id = challenger.user_id if challenger_wins else defender.user_id
-    loser_id = defender.user_id if challenger_wins else challenger.user_id
-    
-    # 奖惩计算
-    exp_reward = int(min(challenger.level, defender.level) * 100)
-    karma_change = 20
-    
-    # 更新胜者数据
-    winner = challenger if challenger_wins else defender
-    winner.cultivation += exp_reward
-    winner.karma += karma_change
-    await winner.save()
-    
-    # 更新败者数据
-    loser = defender if challenger_wins else challenger
-    loser.karma -= karma_change
-    await loser.save()
-    
-    # 记录PK结果
-    await PkRecord.create(
-        challenger_id=challenger.user_id,
-        defender_id=defender.user_id,
-        winner_id=winner_id,
-        challenger_sect_id=challenger.sect_id,
-        defender_sect_id=defender.sect_id,
-        is_sect_pk=False,
-        exp_reward=exp_reward,
-        karma_change=karma_change
-    )
-    
-    # 记录事件
-    await XiuxianEvent.create(
-        user=winner,
-        event_type="PK胜利",
-        event_name=f"击败{loser.user_id}",
-        exp_change=exp_reward,
-        karma_change=karma_change
-    )
-    
-    await XiuxianEvent.create(
-        user=loser,
-        event_type="PK失败",
-        event_name=f"被{winner.user_id}击败",
-        exp_change=0,
-        karma_change=-karma_change
-    )
-    
-    # 构建结果消息
-    if challenger_wins:
-        result_msg = f"🔥 激烈的修仙对决！\n\n{challenger.user_id}（{challenger.get_realm_name()}） VS {defender.user_id}（{defender.get_realm_name()}）\n\n{challenger.user_id} 获胜！\n获得修为 {exp_reward} 点\n获得功德 {karma_change} 点"
-    else:
-        result_msg = f"🔥 激烈的修仙对决！\n\n{challenger.user_id}（{challenger.get_realm_name()}） VS {defender.user_id}（{defender.get_realm_name()}）\n\n{defender.user_id} 获胜！\n获得修为 {exp_reward} 点\n获得功德 {karma_change} 点"
-    
-    await pk_command.finish(result_msg)
+    # 串行处理双方的命令，避免结算期间数据被其他命令修改
+    async with user_locks.hold(user_id, target_id):
+        # 等待期间其他PK可能已经结算
+        remaining_time = cooldowns.remaining("修仙PK", user_id)
+        if remaining_time:
+            await pk_command.finish(f"道友刚经历一场大战，{remaining_time}秒后才能再次PK。")
+            return
+    
+        # 计算战斗力
+        challenger_power = await challenger.get_combat_power()
+        defender_power = await defender.get_combat_power()
+    
+        # 计算胜率
+        win_rate = pk_win_rate(challenger_power, defender_power)  # 保证胜率在20%-80%之间
+    
+        # 随机决定胜负
+        challenger_wins = random.random() < win_rate
+    
+        # 战斗结果
+        winner_id = challenger.user_id if challenger_wins else defender.user_id
+        loser_id = defender.user_id if challenger_wins else challenger.user_id
+    
+        # 奖惩计算
+        exp_reward = pk_exp_reward(challenger.level, defender.level)
+        karma_change = PK_KARMA
+    
+        winner = challenger if challenger_wins else defender
+        loser = defender if challenger_wins else challenger
+    
+        # 在同一事务中以原子增量结算双方数据并写入记录
+        async with in_transaction():
+            await XiuxianUser.filter(id=winner.id).update(
+                cultivation=F("cultivation") + exp_reward,
+                karma=F("karma") + karma_change,
+                combat_power=F("combat_power") + exp_reward,
+            )
+            await XiuxianUser.filter(id=loser.id).update(
+                karma=F("karma") - karma_change
+            )
+            await PkRecord.create(
+                challenger_id=challenger.user_id,
+                defender_id=defender.user_id,
+                winner_id=winner_id,
+                challenger_sect_id=challenger.sect_id,
+                defender_sect_id=defender.sect_id,
+                is_sect_pk=False,
+                exp_reward=exp_reward,
+                karma_change=karma_change
+            )
+            await XiuxianEvent.bulk_create([
+                XiuxianEvent(
+                    user=winner,
+                    event_type="PK胜利",
+                    event_name=f"击败{loser.user_id}",
+                    exp_change=exp_reward,
+                    karma_change=karma_change
+                ),
+                XiuxianEvent(
+                    user=loser,
+                    event_type="PK失败",
+                    event_name=f"被{winner.user_id}击败",
+                    exp_change=0,
+                    karma_change=-karma_change
+                ),
+            ])
+    
+        # 提交成功后同步缓存中的双方数据
+        winner.cultivation += exp_reward
+        winner.karma += karma_change
+        user_cache.mark_committed(winner)
+        loser.karma -= karma_change
+        user_cache.mark_committed(loser)
+        cooldowns.start("修仙PK", user_id, PK_CD)
+    
+        # 构建结果消息
+        if challenger_wins:
+            result_msg = f"🔥 激烈的修仙对决！\n\n{challenger.user_id}（{challenger.get_realm_name()}） VS {defender.user_id}（{defender.get_realm_name()}）\n\n{challenger.user_id} 获胜！\n获得修为 {exp_reward} 点\n获得功德 {karma_change} 点"
+        else:
+            result_msg = f"🔥 激烈的修仙对决！\n\n{challenger.user_id}（{challenger.get_realm_name()}） VS {defender.user_id}（{defender.get_realm_name()}）\n\n{defender.user_id} 获胜！\n获得修为 {exp_reward} 点\n获得功德 {karma_change} 点"
+    
+        await pk_command.finish(result_msg)
 
 # 门派PK命令
 sect_pk = on_command("门派战", aliases={"门派pk", "门派PK"}, priority=5, block=True)
@@ -131,7 +168,7 @@ async def handle_sect_pk(bot: Bot, event: MessageEvent, state: T_State, args: Me
         return
     
     # 获取用户数据
-    user = await XiuxianUser.get_or_none(user_id=user_id)
+    user = await user_cache.get(user_id)
     if not user:
         await sect_pk.finish("道友还未创建角色，请先使用「开始修仙」命令！")
         return
@@ -146,7 +183,7 @@ async def handle_sect_pk(bot: Bot, event: MessageEvent, state: T_State, args: Me
     if not own_sect:
         # 门派数据异常，重置用户门派信息
         user.leave_sect()
-        await user.save()
+        user_cache.mark_dirty(user)
         await sect_pk.finish("未找到门派信息，已重置你的门派状态。")
         return
     
@@ -172,54 +209,141 @@ async def handle_sect_pk(bot: Bot, event: MessageEvent, state: T_State, args: Me
         await sect_pk.finish("不能与自己的门派战斗！")
         return
     
-    # 计算战斗力
-    own_power = await own_sect.get_total_power()
-    target_power = await target_sect.get_total_power()
-    
-    # 计算胜率
-    win_rate = 0.5 + (own_power - target_power) / (own_power + target_power) * 0.3
-    win_rate = max(0.2, min(0.8, win_rate))  # 保证胜率在20%-80%之间
-    
-    # 随机决定胜负
-    own_sect_wins = random.random() < win_rate
-    
-    # 计算奖惩
-    resource_reward = random.randint(50, 100)
-    
-    # 更新胜者和败者门派资源
-    if own_sect_wins:
-        own_sect.resources += resource_reward
-        target_sect.resources = max(0, target_sect.resources - resource_reward)
-        winner_sect = own_sect
-        loser_sect = target_sect
-    else:
-        target_sect.resources += resource_reward
-        own_sect.resources = max(0, own_sect.resources - resource_reward)
-        winner_sect = target_sect
-        loser_sect = own_sect
-    
-    await own_sect.save()
-    await target_sect.save()
-    
-    # 记录PK结果
-    await PkRecord.create(
-        challenger_id=user_id,
-        defender_id="system",  # 门派战没有具体防守者
-        winner_id="system",
-        challenger_sect_id=own_sect.id,
-        defender_sect_id=target_sect.id,
-        is_sect_pk=True,
-        exp_reward=0,
-        karma_change=0
-    )
-    
-    # 构建结果消息
-    result_msg = f"""⚔️ 激烈的门派对决！
-我方: {own_sect.name} (总战力: {own_power})
-对方: {target_sect.name} (总战力: {target_power})
-
-结果: {'我方获胜' if own_sect_wins else '对方获胜'}！
-{'我方' if own_sect_wins else '对方'}获得资源 {resource_reward} 点
+    # 串行处理双方门派及全部成员的结算，锁内重新读取资源
+    async with user_cache.hold_sect_members(own_sect.id, target_sect.id) as members:
+        own_members, target_members = members
+        await own_sect.refresh_from_db(fields=["resources"])
+        await target_sect.refresh_from_db(fields=["resources"])
+    
+        # 双方成员按战斗力配对，同时进行多场对决
+        pairs = pair_duels(own_members, target_members)
+        if not pairs:
+            await sect_pk.finish(f"门派「{target_sect.name}」没有可以出战的成员！")
+            return
+        results = resolve_duels(pairs)
+        own_wins = sum(results)
+        target_wins = len(results) - own_wins
+    
+        # 胜场多的门派获胜，平局不转移资源
+        resource_reward = random.randint(50, 100)
+        if own_wins == target_wins:
+            winner_sect = loser_sect = None
+            resource_loss = 0
+        else:
+            winner_sect = own_sect if own_wins > target_wins else target_sect
+            loser_sect = target_sect if own_wins > target_wins else own_sect
+            # 败者资源最多扣到 0
+            resource_loss = min(resource_reward, loser_sect.resources)
+    
+        # 先在内存中结算各场对决，失败时撤销
+        changed, records = settle_duels(pairs, results, own_sect.id, target_sect.id)
+        try:
+            async with in_transaction():
+                await bulk_update_rows(
+                    XiuxianUser, changed, ["cultivation", "karma", "combat_power"]
+                )
+                await PkRecord.bulk_create(
+                    records, batch_size=SECT_PK_RECORD_BATCH_SIZE
+                )
+                if winner_sect is not None:
+                    await Sect.filter(id=winner_sect.id).update(
+                        resources=F("resources") + resource_reward
+                    )
+                    await Sect.filter(id=loser_sect.id).update(
+                        resources=F("resources") - resource_loss
+                    )
+        except Exception:
+            revert_duels(pairs, results)
+            raise
+        for user in changed:
+            user_cache.mark_committed(user)
+        if winner_sect is not None:
+            render_cache.bump(sect_info_key(winner_sect.id))
+            render_cache.bump(sect_info_key(loser_sect.id))
+            winner_sect.resources += resource_reward
+            loser_sect.resources -= resource_loss
+    
+        if winner_sect is None:
+            result = "平局"
+        else:
+            result = "我方获胜" if winner_sect is own_sect else "对方获胜"
+        result_msg = f"""⚔️ 激烈的门派对决！
+我方: {own_sect.name} (出战 {len(own_members)} 人)
+对方: {target_sect.name} (出战 {len(target_members)} 人)
+共 {len(pairs)} 场对决，我方胜 {own_wins} 场，对方胜 {target_wins} 场
+
+结果: {result}！
 """
+        if winner_sect is not None:
+            result_msg += f"{'我方' if winner_sect is own_sect else '对方'}获得资源 {resource_reward} 点\n"
     
-    await sect_pk.finish(result_msg) 
\ No newline at end of file
+        await sect_pk.finish(result_msg)
+
+
+def pair_duels(attackers, defenders):
+    """双方成员按战斗力从高到低依次配对，人数多的一方多出的成员轮空
+
+    Returns:
+        (进攻方成员, 防守方成员) 列表
+    """
+    power = XiuxianUser.calc_combat_power
+    return list(zip(
+        sorted(attackers, key=power, reverse=True),
+        sorted(defenders, key=power, reverse=True),
+    ))
+
+
+def resolve_duels(pairs):
+    """一次算出所有对决的胜负，胜率公式与修仙PK相同
+
+    Returns:
+        每场对决进攻方是否获胜
+    """
+    powers = [(a.calc_combat_power(), d.calc_combat_power()) for a, d in pairs]
+    if np is None:
+        return [random.random() < pk_win_rate(a, d) for a, d in powers]
+    # 安装了 NumPy 时整批计算，随机数种子取自 random 以便复现
+    powers = np.array(powers, dtype=np.float64).reshape(-1, 2)
+    rng = np.random.default_rng(random.getrandbits(64))
+    rates = pk_win_rate(powers[:, 0], powers[:, 1])
+    return (rng.random(len(powers)) < rates).tolist()
+
+
+def settle_duels(pairs, results, attacker_sect_id, defender_sect_id):
+    """在内存中结算对决奖惩
+
+    Returns:
+        (修改过的成员列表, PkRecord 列表)
+    """
+    changed = {}
+    records = []
+    for (attacker, defender), attacker_wins in zip(pairs, results):
+        winner, loser = (attacker, defender) if attacker_wins else (defender, attacker)
+        exp_reward = pk_exp_reward(attacker.level, defender.level)
+        winner.cultivation += exp_reward
+        winner.karma += PK_KARMA
+        loser.karma -= PK_KARMA
+        winner.refresh_combat_power()
+        changed[winner.user_id] = winner
+        changed[loser.user_id] = loser
+        records.append(PkRecord(
+            challenger_id=attacker.user_id,
+            defender_id=defender.user_id,
+            winner_id=winner.user_id,
+            challenger_sect_id=attacker_sect_id,
+            defender_sect_id=defender_sect_id,
+            is_sect_pk=True,
+            exp_reward=exp_reward,
+            karma_change=PK_KARMA
+        ))
+    return list(changed.values()), records
+
+
+def revert_duels(pairs, results):
+    """撤销 settle_duels 在内存中的修改"""
+    for (attacker, defender), attacker_wins in zip(pairs, results):
+        winner, loser = (attacker, defender) if attacker_wins else (defender, attacker)
+        winner.cultivation -= pk_exp_reward(attacker.level, defender.level)
+        winner.karma -= PK_KARMA
+        loser.karma += PK_KARMA
+        winner.refresh_combat_power()
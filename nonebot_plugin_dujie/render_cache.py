@@ -0,0 +1,95 @@
+"""
+回复文本缓存
+作者: biupiaa
+"""
+
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Hashable, List, Optional
+
+import nonebot
+
+config = nonebot.get_driver().config
+
+# 缓存的回复条数，0表示不缓存
+RENDER_CACHE_SIZE = int(getattr(config, "xiuxian_render_cache_size", 5000))
+# 回复最长缓存时间(秒)，兜底只读副本的复制延迟等未经 bump 的变化
+RENDER_CACHE_TTL = float(getattr(config, "xiuxian_render_cache_ttl", 60))
+
+
+class RenderCache:
+    """按 (实体, 版本) 缓存查看类命令的回复文本
+
+    用户或门派数据变化时调用 bump 提升版本，旧版本的文本随即失效。
+    渲染前先用 version 取得当前版本，渲染期间（查询数据库时）若发生修改，
+    版本不一致的文本不会被存入，避免缓存旧数据。
+    """
+
+    def __init__(
+        self, max_size: int = RENDER_CACHE_SIZE, ttl: float = RENDER_CACHE_TTL
+    ):
+        """
+        Args:
+            max_size: 最多缓存的实体数
+            ttl: 文本的过期时间(秒)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # 实体 -> [版本, 回复文本, 过期时间]，文本为 None 表示尚未渲染或已失效
+        self._items: "OrderedDict[Hashable, List]" = OrderedDict()
+        # 版本号全局递增，实体被淘汰后重新加入也不会与旧版本重复
+        self._versions = count(1)
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, key: Hashable) -> int:
+        """实体的当前版本"""
+        item = self._items.get(key)
+        if item is None:
+            item = self._items[key] = [next(self._versions), None, 0.0]
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return item[0]
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """获取实体当前版本的回复文本，没有时返回 None"""
+        item = self._items.get(key)
+        if item is None or item[1] is None or item[2] <= time.monotonic():
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: Hashable, version: int, text: str):
+        """存入按 version 版本渲染的回复文本，版本已变化时丢弃"""
+        if not self.max_size:
+            return
+        item = self._items.get(key)
+        if item is not None and item[0] == version:
+            item[1] = text
+            item[2] = time.monotonic() + self.ttl
+
+    def bump(self, key: Hashable):
+        """实体数据已变化，提升版本"""
+        item = self._items.get(key)
+        if item is not None:
+            item[0] = next(self._versions)
+            item[1] = None
+
+    def clear(self):
+        self._items.clear()
+
+
+render_cache = RenderCache()
+
+
+def status_key(user_id: str) -> tuple:
+    """查看状态回复的缓存键"""
+    return ("user", user_id)
+
+
+def sect_info_key(sect_id: int) -> tuple:
+    """门派信息回复的缓存键"""
+    return ("sect", sect_id)
@@ -0,0 +1,142 @@
+"""
+事件日志归档模块
+作者: biupiaa
+"""
+
+import asyncio
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Tuple
+
+import nonebot
+from tortoise import timezone
+from tortoise.transactions import in_transaction
+
+from .log import logger
+from .models import XiuxianEvent, XiuxianEventDaily
+from .scheduler import PeriodicTask
+
+config = nonebot.get_driver().config
+
+# 事件明细保留天数，小于等于0时不归档
+RETENTION_DAYS = int(getattr(config, "xiuxian_event_retention_days", 30))
+# 每批归档的事件条数与批次间隔(秒)
+ROLLUP_BATCH_SIZE = int(getattr(config, "xiuxian_event_rollup_batch", 1000))
+ROLLUP_PAUSE = float(getattr(config, "xiuxian_event_rollup_pause", 0.1))
+# 归档任务执行间隔(秒)
+ROLLUP_INTERVAL = float(getattr(config, "xiuxian_event_rollup_interval", 3600))
+
+
+def _local_date(value: datetime) -> date:
+    """转换为本地日期"""
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+async def rollup_batch(cutoff: datetime) -> int:
+    """归档一批早于 cutoff 的事件
+
+    明细按 (用户, 日期, 事件类型) 累加到汇总表后删除，
+    同一批在一个短事务中完成。
+
+    Args:
+        cutoff: 截止时间
+
+    Returns:
+        本批归档的事件条数
+    """
+    # 按时间索引取最早的一批，没有过期事件时不会扫描整张表
+    rows = await (
+        XiuxianEvent.filter(created_at__lt=cutoff)
+        .order_by("created_at")
+        .limit(ROLLUP_BATCH_SIZE)
+        .values("id", "user_id", "event_type", "exp_change", "karma_change", "created_at")
+    )
+    if not rows:
+        return 0
+
+    totals: Dict[Tuple[int, date, str], List[int]] = {}
+    for row in rows:
+        key = (row["user_id"], _local_date(row["created_at"]), row["event_type"])
+        total = totals.setdefault(key, [0, 0, 0])
+        total[0] += 1
+        total[1] += row["exp_change"]
+        total[2] += row["karma_change"]
+
+    async with in_transaction():
+        existing = await XiuxianEventDaily.filter(
+            user_id__in={key[0] for key in totals},
+            day__in={key[1] for key in totals},
+            event_type__in={key[2] for key in totals},
+        )
+        updated = []
+        for daily in existing:
+            total = totals.pop((daily.user_id, daily.day, daily.event_type), None)
+            if total is None:
+                continue
+            daily.count += total[0]
+            daily.exp_change += total[1]
+            daily.karma_change += total[2]
+            updated.append(daily)
+        if updated:
+            await XiuxianEventDaily.bulk_update(
+                updated, fields=["count", "exp_change", "karma_change"]
+            )
+        if totals:
+            await XiuxianEventDaily.bulk_create(
+                [
+                    XiuxianEventDaily(
+                        user_id=user_id,
+                        day=day,
+                        event_type=event_type,
+                        count=count,
+                        exp_change=exp_change,
+                        karma_change=karma_change,
+                    )
+                    for (user_id, day, event_type), (
+                        count,
+                        exp_change,
+                        karma_change,
+                    ) in totals.items()
+                ]
+            )
+        await XiuxianEvent.filter(id__in=[row["id"] for row in rows]).delete()
+    return len(rows)
+
+
+async def rollup_events(retention_days: int = RETENTION_DAYS) -> int:
+    """归档所有超过保留期的事件
+
+    Args:
+        retention_days: 明细保留天数
+
+    Returns:
+        归档的事件条数
+    """
+    if retention_days <= 0:
+        return 0
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    total = 0
+    while True:
+        count = await rollup_batch(cutoff)
+        total += count
+        if count < ROLLUP_BATCH_SIZE:
+            break
+        # 批次之间让出写锁
+        await asyncio.sleep(ROLLUP_PAUSE)
+    if total:
+        logger.info(f"事件日志归档完成, 共归档 {total} 条")
+    return total
+
+
+rollup_task = PeriodicTask("事件日志归档", ROLLUP_INTERVAL, rollup_events)
+
+
+async def start_event_rollup():
+    """启动事件归档任务"""
+    rollup_task.start()
+
+
+async def stop_event_rollup():
+    """停止事件归档任务"""
+    await rollup_task.stop()
@@ -0,0 +1,66 @@
+"""
+后台周期任务
+作者: biupiaa
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+from .log import logger
+
+
+class PeriodicTask:
+    """按固定间隔执行的后台任务
+
+    停止时会等待正在执行的一轮结束，不会在执行中途取消，
+    避免回写类任务被打断后丢失数据。
+    """
+
+    def __init__(self, name: str, interval: float, func: Callable[[], Awaitable[Any]]):
+        """
+        Args:
+            name: 任务名称，用于日志
+            interval: 执行间隔(秒)
+            func: 每轮执行的协程函数
+        """
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    @property
+    def running(self) -> bool:
+        """任务是否在运行"""
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """启动任务"""
+        if self.running:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止任务，等待当前一轮执行完毕"""
+        if not self.running:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def run_once(self):
+        """立即执行一轮，异常只记录日志"""
+        try:
+            await self.func()
+        except Exception as e:
+            logger.error(f"后台任务 {self.name} 执行出错", e=e)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            await self.run_once()
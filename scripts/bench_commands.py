@@ -0,0 +1,614 @@
+"""
+命令处理器基准测试
+作者: biupiaa
+
+用伪造的 OneBot v11 Bot 和群消息事件逐条驱动插件的全部命令，
+数据库为临时 SQLite，按 --users/--sects 预先填充玩家和门派。
+每条命令输出延迟分位数、平均 SQL 语句数和内存分配，
+可保存为 JSON 并与上一次的结果对比，发现性能回退。
+
+需要在插件的运行环境中执行（已安装 NoneBot2、OneBot 适配器和
+插件依赖的其他包），不会连接真实的机器人或数据库。
+
+命令之后测量数据库写入吞吐：逐条自动提交的单行更新，以及按事件日志
+的方式分批在事务中插入。--sqlite-pragmas default 使用 SQLite 的默认设置
+（回滚日志、每次提交同步磁盘），用于对比插件 pragma 配置的效果。
+
+用法:
+    python scripts/bench_commands.py --users 10000 --sects 20
+    python scripts/bench_commands.py --save bench.json
+    python scripts/bench_commands.py --baseline bench.json --threshold 0.2
+    python scripts/bench_commands.py --only 修炼 --sqlite-pragmas default
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter, Bot, GroupMessageEvent, Message
+from nonebot.adapters.onebot.v11.event import Sender
+from tortoise import Tortoise
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 开始修仙使用的新玩家QQ号从这里开始，不与预置玩家重复
+NEW_USER_BASE = 900000000
+SEED_USER_BASE = 100000000
+
+# --sqlite-pragmas default 时覆盖插件的 pragma 配置，恢复 SQLite 的默认行为
+SQLITE_DEFAULT_PRAGMAS = {
+    "xiuxian_sqlite_journal_mode": "DELETE",
+    "xiuxian_sqlite_synchronous": "FULL",
+    "xiuxian_sqlite_cache_size": "",
+    "xiuxian_sqlite_mmap_size": "",
+    "xiuxian_sqlite_temp_store": "",
+    "xiuxian_sqlite_busy_timeout": "",
+}
+# 事务写入测试每批插入的行数
+WRITE_BATCH = 50
+
+
+class FakeBot(Bot):
+    """不连接协议端的 Bot，发送的消息只计数"""
+
+    sent = 0
+
+    async def send(self, event, message, **kwargs):
+        FakeBot.sent += 1
+        return {"message_id": 0}
+
+    async def call_api(self, api: str, **data):
+        return {"message_id": 0}
+
+
+class QueryCounter(logging.Handler):
+    """统计 Tortoise 执行的 SQL 语句数
+
+    Tortoise 的各数据库后端执行语句时都会写 tortoise.db_client 的 debug 日志，
+    这里只计数，不格式化也不输出。
+    """
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.count += 1
+
+    def install(self):
+        db_logger = logging.getLogger("tortoise.db_client")
+        db_logger.setLevel(logging.DEBUG)
+        db_logger.propagate = False
+        db_logger.addHandler(self)
+
+
+class Scenario:
+    """一条命令的基准场景
+
+    next_call 依次给出 (发送者QQ号, 消息文本)，计时和内存两轮测量
+    连续取用，同一玩家不会重复触发冷却或次数限制。
+    """
+
+    def __init__(self, name: str, make_call: Callable[[int], Tuple[str, str]]):
+        self.name = name
+        self._make_call = make_call
+        self._index = 0
+
+    def next_call(self) -> Tuple[str, str]:
+        call = self._make_call(self._index)
+        self._index += 1
+        return call
+
+
+class Seed:
+    """预置的玩家和门派"""
+
+    def __init__(self):
+        # 门派名 -> (掌门QQ号, 成员QQ号列表)
+        self.sects: Dict[str, Tuple[str, List[str]]] = {}
+        # 全部玩家、门派成员（不含掌门）和无门派的玩家
+        self.users: List[str] = []
+        self.members: List[str] = []
+        self.free: List[str] = []
+
+
+async def seed_database(
+    users: int,
+    sects: int,
+    member_ratio: float,
+    rng: random.Random,
+    user_ids: Optional[List[str]] = None,
+) -> Seed:
+    """批量写入预置数据，门派成员数和总战力直接按成员计算
+
+    Args:
+        users: 玩家数，给出 user_ids 时忽略
+        sects: 门派数
+        member_ratio: 玩家中门派成员的比例
+        rng: 随机数生成器
+        user_ids: 指定玩家QQ号，默认从 SEED_USER_BASE 起连续编号
+    """
+    from nonebot_plugin_dujie.constants import ELEMENT_COEFFICIENTS
+    from nonebot_plugin_dujie.leaderboard import leaderboard
+    from nonebot_plugin_dujie.models import Sect, XiuxianUser
+
+    if user_ids is None:
+        user_ids = [str(SEED_USER_BASE + i) for i in range(users)]
+
+    elements = list(ELEMENT_COEFFICIENTS)
+    seed = Seed()
+    rows = []
+    sect_rows = [
+        Sect(id=i + 1, name=f"基准门派{i + 1}", leader_id="", resources=1000)
+        for i in range(sects)
+    ]
+    for user_id in user_ids:
+        in_sect = sects and rng.random() < member_ratio
+        # 无门派玩家不低于金丹期，可以创建门派
+        level = rng.randint(1, 8) if in_sect else rng.randint(3, 8)
+        user = XiuxianUser(
+            user_id=user_id,
+            level=level,
+            element=rng.choice(elements),
+            # 约一半玩家的修为足够渡劫
+            cultivation=rng.randint(0, (level + 2) * 1000),
+            karma=rng.randint(0, 500),
+            artifacts=[],
+            sect_id=rng.randint(1, sects) if in_sect else 0,
+        )
+        user.refresh_combat_power()
+        rows.append(user)
+        if in_sect:
+            sect = sect_rows[user.sect_id - 1]
+            sect.member_count += 1
+            sect.total_power += user.combat_power
+            if not sect.leader_id:
+                sect.leader_id = user_id
+                seed.sects[sect.name] = (user_id, [])
+            else:
+                seed.sects[sect.name][1].append(user_id)
+                seed.members.append(user_id)
+        else:
+            seed.free.append(user_id)
+
+    # 没有成员的门派由一名无门派玩家担任掌门
+    for sect in sect_rows:
+        if not sect.leader_id and seed.free:
+            user_id = seed.free.pop()
+            user = rows[user_ids.index(user_id)]
+            user.sect_id = sect.id
+            sect.leader_id = user_id
+            sect.member_count = 1
+            sect.total_power = user.combat_power
+            seed.sects[sect.name] = (user_id, [])
+
+    await Sect.bulk_create(sect_rows)
+    await XiuxianUser.bulk_create(rows, batch_size=1000)
+    # 排行榜在启动时已加载（空库），填充后重新加载
+    await leaderboard.load()
+    seed.users = list(user_ids)
+    rng.shuffle(seed.members)
+    rng.shuffle(seed.free)
+    return seed
+
+
+def build_scenarios(seed: Seed, per_scenario: int, random_seed: int) -> List[Scenario]:
+    """按固定顺序生成各命令的场景
+
+    每个场景使用互不重叠的一段玩家和独立的随机数，
+    结果不受 --only 选择了哪些命令影响。
+    """
+    members = seed.members
+    sect_names = list(seed.sects)
+    # 无门派玩家一半创建门派，一半加入门派
+    creators, joiners = seed.free[0::2], seed.free[1::2]
+
+    def players(slot: int) -> Callable[[int], str]:
+        return lambda i: members[(slot * per_scenario + i) % len(members)]
+
+    def rng(name: str) -> random.Random:
+        return random.Random(f"{random_seed}:{name}")
+
+    pk_rng, join_rng = rng("修仙PK"), rng("加入门派")
+    appoint_rng, war_rng = rng("任命长老"), rng("门派战")
+    status, cultivate, explore, tribulate, seclude, rank, pk, info, leave = (
+        players(slot) for slot in range(9)
+    )
+
+    def appoint(i: int) -> Tuple[str, str]:
+        leader, sect_members = seed.sects[sect_names[i % len(sect_names)]]
+        target = appoint_rng.choice(sect_members) if sect_members else leader
+        return leader, f"任命长老 {target}"
+
+    def sect_war(i: int) -> Tuple[str, str]:
+        own, target = war_rng.sample(sect_names, 2)
+        return seed.sects[own][0], f"门派战 {target}"
+
+    scenarios = [
+        Scenario("开始修仙", lambda i: (str(NEW_USER_BASE + i), "开始修仙")),
+        Scenario("查看状态", lambda i: (status(i), "查看状态")),
+        Scenario("修炼", lambda i: (cultivate(i), "修炼")),
+        Scenario("探索", lambda i: (explore(i), "探索")),
+        Scenario("渡劫", lambda i: (tribulate(i), "渡劫")),
+        # 闭关和出关按相同顺序取用同一批玩家
+        Scenario("闭关", lambda i: (seclude(i), "闭关")),
+        Scenario("出关", lambda i: (seclude(i), "出关")),
+        Scenario("修仙排行", lambda i: (rank(i), "修仙排行")),
+        Scenario("修仙PK", lambda i: (pk(i), f"修仙PK {pk_rng.choice(members)}")),
+        Scenario("门派信息", lambda i: (info(i), "门派信息")),
+        Scenario(
+            "创建门派",
+            lambda i: (creators[i % len(creators)], f"创建门派 新门派{i}"),
+        ),
+        Scenario(
+            "加入门派",
+            lambda i: (
+                joiners[i % len(joiners)],
+                f"加入门派 {join_rng.choice(sect_names)}",
+            ),
+        ),
+        Scenario("任命长老", appoint),
+        Scenario("门派战", sect_war),
+        # 退出门派会减少成员，放在最后
+        Scenario("退出门派", lambda i: (leave(i), "退出门派")),
+    ]
+    if len(sect_names) < 2:
+        scenarios = [s for s in scenarios if s.name != "门派战"]
+    if not creators or not joiners:
+        scenarios = [s for s in scenarios if s.name not in ("创建门派", "加入门派")]
+    return scenarios
+
+
+_message_id = 0
+
+
+def make_event(user_id: str, text: str, group_id: int = 100) -> GroupMessageEvent:
+    global _message_id
+    _message_id += 1
+    return GroupMessageEvent(
+        time=int(time.time()),
+        self_id=10000,
+        post_type="message",
+        sub_type="normal",
+        user_id=int(user_id),
+        message_type="group",
+        message_id=_message_id,
+        message=Message(text),
+        original_message=Message(text),
+        raw_message=text,
+        font=0,
+        sender=Sender(user_id=int(user_id)),
+        group_id=group_id,
+        to_me=False,
+    )
+
+
+class HandlerProbe:
+    """通过运行前/后处理钩子测量命中的处理器本身
+
+    handle_event 的耗时包含 NoneBot 逐个检查所有匹配器规则的开销，
+    处理器的变化容易被淹没，因此分别记录。
+    """
+
+    def __init__(self):
+        self.started = 0.0
+        self.elapsed = 0.0
+        self.base = 0
+        self.peak = 0
+        self.retained = 0
+
+    def begin(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.started = time.perf_counter()
+
+    def end(self):
+        self.elapsed = time.perf_counter() - self.started
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = peak - self.base
+            self.retained = current - self.base
+
+    def install(self):
+        from nonebot.message import run_postprocessor, run_preprocessor
+
+        @run_preprocessor
+        async def _begin():
+            self.begin()
+
+        @run_postprocessor
+        async def _end():
+            self.end()
+
+
+def percentiles(values: List[float]) -> List[float]:
+    """第 1 到 99 百分位数"""
+    if len(values) < 2:
+        return values * 99
+    return statistics.quantiles(values, n=100, method="inclusive")
+
+
+async def run_scenario(
+    bot: Bot,
+    scenario: Scenario,
+    iterations: int,
+    alloc_iterations: int,
+    counter: QueryCounter,
+    probe: HandlerProbe,
+) -> dict:
+    """先计时并统计 SQL，再在 tracemalloc 下测量处理器的内存分配"""
+    from nonebot.message import handle_event
+
+    latencies = []
+    dispatch = []
+    queries = []
+    for _ in range(iterations):
+        event = make_event(*scenario.next_call())
+        before = counter.count
+        started = time.perf_counter()
+        await handle_event(bot, event)
+        dispatch.append((time.perf_counter() - started) * 1000)
+        latencies.append(probe.elapsed * 1000)
+        queries.append(counter.count - before)
+
+    peaks = []
+    retained = []
+    if alloc_iterations:
+        tracemalloc.start()
+        for _ in range(alloc_iterations):
+            await handle_event(bot, make_event(*scenario.next_call()))
+            peaks.append(probe.peak / 1024)
+            retained.append(probe.retained / 1024)
+        tracemalloc.stop()
+
+    cuts = percentiles(latencies)
+    return {
+        "n": iterations,
+        "p50_ms": round(cuts[49], 3),
+        "p95_ms": round(cuts[94], 3),
+        "p99_ms": round(cuts[98], 3),
+        "max_ms": round(max(latencies), 3),
+        "dispatch_p50_ms": round(percentiles(dispatch)[49], 3),
+        "queries": round(statistics.mean(queries), 2),
+        "peak_kib": round(statistics.mean(peaks), 1) if peaks else 0.0,
+        "retained_kib": round(statistics.mean(retained), 1) if retained else 0.0,
+    }
+
+
+def display_width(text: str) -> int:
+    """终端显示宽度，中文占两格"""
+    return sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+
+
+def pad(text: str, width: int, left: bool = False) -> str:
+    space = " " * max(width - display_width(text), 0)
+    return text + space if left else space + text
+
+
+COLUMNS = (
+    ("p50(ms)", "p50_ms", "{:.2f}"),
+    ("p95(ms)", "p95_ms", "{:.2f}"),
+    ("p99(ms)", "p99_ms", "{:.2f}"),
+    ("max(ms)", "max_ms", "{:.2f}"),
+    ("分发p50", "dispatch_p50_ms", "{:.2f}"),
+    ("SQL/次", "queries", "{:.2f}"),
+    ("峰值KiB", "peak_kib", "{:.1f}"),
+    ("留存KiB", "retained_kib", "{:.1f}"),
+)
+
+
+def print_results(results: Dict[str, dict]):
+    print(
+        pad("命令", 10, left=True)
+        + pad("次数", 6)
+        + "".join(pad(title, 10) for title, _, _ in COLUMNS)
+    )
+    for name, r in results.items():
+        print(
+            pad(name, 10, left=True)
+            + pad(str(r["n"]), 6)
+            + "".join(pad(fmt.format(r[key]), 10) for _, key, fmt in COLUMNS)
+        )
+
+
+def compare(
+    results: Dict[str, dict], baseline: Dict[str, dict], threshold: float
+) -> List[str]:
+    """找出 p95 延迟、SQL 数或峰值内存超过基线 (1 + threshold) 倍的命令"""
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ("p95_ms", "queries", "peak_kib"):
+            if r[key] > base[key] * (1 + threshold) and r[key] - base[key] > 0.5:
+                regressions.append(f"{name} {key}: {base[key]} -> {r[key]}")
+    return regressions
+
+
+def init_plugin(db_path: Path, log_level: str, **config):
+    """以临时数据库初始化 NoneBot 并加载插件，命令不需要前缀
+
+    Args:
+        db_path: SQLite 数据库文件
+        log_level: 日志级别
+        config: 额外的插件配置
+    """
+    sys.path.insert(0, str(ROOT))
+    nonebot.init(
+        driver="~none",
+        db_url=f"sqlite://{db_path}",
+        command_start={""},
+        log_level=log_level,
+        **config,
+    )
+    nonebot.get_driver().register_adapter(Adapter)
+    nonebot.load_plugin("nonebot_plugin_dujie")
+
+
+async def start_plugin() -> Bot:
+    """执行插件的启动钩子，返回伪造的 Bot"""
+    driver = nonebot.get_driver()
+    await driver._lifespan.startup()
+    return FakeBot(Adapter(driver), "10000")
+
+
+async def stop_plugin():
+    """执行关闭钩子（回写缓存等）并断开数据库"""
+    await nonebot.get_driver()._lifespan.shutdown()
+    await Tortoise.close_connections()
+
+
+async def measure_writes(seed: Seed, count: int) -> Dict[str, float]:
+    """测量每秒写入行数
+
+    自动提交: 逐条执行单行 UPDATE，每条语句各自提交；
+    事务: 每 WRITE_BATCH 行事件记录在一个事务中批量插入。
+    """
+    from tortoise.expressions import F
+    from tortoise.transactions import in_transaction
+
+    from nonebot_plugin_dujie.models import XiuxianEvent, XiuxianUser
+
+    user_ids = seed.users[:count] or [str(SEED_USER_BASE)]
+    started = time.perf_counter()
+    for i in range(count):
+        await XiuxianUser.filter(user_id=user_ids[i % len(user_ids)]).update(
+            karma=F("karma") + 1
+        )
+    autocommit = time.perf_counter() - started
+
+    user = await XiuxianUser.get(user_id=user_ids[0])
+    started = time.perf_counter()
+    for start in range(0, count, WRITE_BATCH):
+        rows = [
+            XiuxianEvent(
+                user=user,
+                event_type="基准",
+                event_name="写入",
+                exp_change=0,
+                karma_change=0,
+            )
+            for _ in range(min(WRITE_BATCH, count - start))
+        ]
+        async with in_transaction():
+            await XiuxianEvent.bulk_create(rows)
+    batched = time.perf_counter() - started
+    return {
+        "autocommit_rows_per_s": round(count / autocommit, 1),
+        "batched_rows_per_s": round(count / batched, 1),
+    }
+
+
+async def run(
+    args,
+) -> Tuple[float, Dict[str, dict], Optional[Dict[str, float]]]:
+    """执行全部测试
+
+    Returns:
+        (预置数据用时, 各命令结果, 写入吞吐)
+    """
+    bot = await start_plugin()
+    try:
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        seed = await seed_database(args.users, args.sects, args.member_ratio, rng)
+        seeding = time.perf_counter() - started
+        counter = QueryCounter()
+        counter.install()
+        probe = HandlerProbe()
+        probe.install()
+        only = set(args.only.split(",")) if args.only else None
+        results = {}
+        for scenario in build_scenarios(
+            seed, args.iterations + args.alloc_iterations, args.seed
+        ):
+            if only and scenario.name not in only:
+                continue
+            results[scenario.name] = await run_scenario(
+                bot, scenario, args.iterations, args.alloc_iterations, counter, probe
+            )
+        writes = await measure_writes(seed, args.writes) if args.writes else None
+        return seeding, results, writes
+    finally:
+        await stop_plugin()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="命令处理器基准测试")
+    parser.add_argument("--users", type=int, default=10000, help="预置玩家数")
+    parser.add_argument("--sects", type=int, default=20, help="预置门派数")
+    parser.add_argument(
+        "--member-ratio", type=float, default=0.8, help="预置玩家中门派成员的比例"
+    )
+    parser.add_argument("--iterations", type=int, default=200, help="每条命令计时次数")
+    parser.add_argument(
+        "--alloc-iterations", type=int, default=20, help="每条命令测量内存分配的次数"
+    )
+    parser.add_argument("--only", default="", help="只测试这些命令，逗号分隔")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--save", type=Path, help="结果保存为 JSON")
+    parser.add_argument("--baseline", type=Path, help="与之前保存的结果对比")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="超过基线的比例视为回退"
+    )
+    parser.add_argument("--log-level", default="WARNING", help="NoneBot 日志级别")
+    parser.add_argument(
+        "--writes", type=int, default=1000, help="写入吞吐测试的行数，0 为不测"
+    )
+    parser.add_argument(
+        "--sqlite-pragmas",
+        choices=("plugin", "default"),
+        default="plugin",
+        help="plugin 使用插件的 pragma 配置，default 使用 SQLite 默认设置",
+    )
+    args = parser.parse_args()
+
+    config = SQLITE_DEFAULT_PRAGMAS if args.sqlite_pragmas == "default" else {}
+    with tempfile.TemporaryDirectory() as tmp:
+        init_plugin(Path(tmp) / "bench.db", args.log_level, **config)
+        started = time.perf_counter()
+        seeding, results, writes = asyncio.run(run(args))
+        elapsed = time.perf_counter() - started
+
+    print(
+        f"预置 {args.users} 名玩家、{args.sects} 个门派用时 {seeding:.1f} 秒，"
+        f"测试共用时 {elapsed:.1f} 秒\n"
+    )
+    print_results(results)
+    if writes:
+        print(
+            f"\n写入吞吐（{args.sqlite_pragmas} pragma）: "
+            f"自动提交 {writes['autocommit_rows_per_s']:.0f} 行/秒，"
+            f"事务批量 {writes['batched_rows_per_s']:.0f} 行/秒"
+        )
+
+    if args.save:
+        args.save.write_text(
+            json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\n性能回退:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\n未发现性能回退")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""
+消息负载测试
+作者: biupiaa
+
+向一个 NoneBot 进程注入 OneBot v11 群消息事件并逐级提高负载，
+输出每一级的吞吐量、延迟分位数和错误率，用于估算单个机器人进程能承受的消息量。
+
+消息有两种来源:
+    合成流量: 按 --mix 的命令比例生成，发送者活跃度服从 Zipf 分布
+        （少数玩家发送大部分消息）。--mode rate 按泊松到达控制每秒消息数，
+        --mode workers 由若干并发发送者收到回复后立即发送下一条。
+    日志回放: 从 log.py 写入的每日日志中还原 OneBot 适配器记录的群消息，
+        按原始间隔除以各级的加速倍数重新发送。日志中出现的玩家会预先建号，
+        门派名等参数原样发送，不保证在临时数据库中存在。
+
+延迟从消息计划发送的时刻算起，事件循环过载导致的发送延后也计入延迟。
+与 bench_commands.py 相同，数据库为临时 SQLite，需要在插件的运行环境中执行。
+
+用法:
+    python scripts/load_test.py --stages 50,100,200,400 --duration 30
+    python scripts/load_test.py --mode workers --stages 1,4,16,64
+    python scripts/load_test.py --replay logs/2024-05-01.log --stages 1,10,100
+"""
+
+import argparse
+import ast
+import asyncio
+import json
+import random
+import re
+import tempfile
+from datetime import datetime
+from itertools import accumulate, count
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bench_commands import (NEW_USER_BASE, Seed, init_plugin, make_event,
+                            pad, percentiles, seed_database, start_plugin,
+                            stop_plugin)
+
+# 默认命令比例，「闲聊」为不触发任何命令的普通群消息
+DEFAULT_MIX = (
+    "闲聊=20,修炼=25,查看状态=12,探索=10,修仙PK=7,修仙排行=5,渡劫=4,"
+    "门派信息=4,闭关=2,出关=2,开始修仙=2,加入门派=1,退出门派=1,"
+    "任命长老=0.5,创建门派=0.5,门派战=0.5"
+)
+CHATTER = ("早上好", "哈哈哈哈", "[图片]", "今天修炼了吗", "+1", "有人打副本吗")
+
+# OneBot 适配器记录收到的群消息，例如:
+# 10-18 09:33:03 [SUCCESS] nonebot | OneBot V11 999 | [message.group.normal]:
+# Message 1 from 10001@[群:100] '修炼'
+LOG_PATTERN = re.compile(
+    r"^(\d\d-\d\d \d\d:\d\d:\d\d) \[SUCCESS\] nonebot \| OneBot V11 \S+ \| "
+    r"\[message\.group\.\w+\]: Message \S+ from (\d+)@\[群:(\d+)\] (.+)$"
+)
+LOG_DATE_PATTERN = re.compile(r"(\d{4})-\d\d-\d\d")
+
+# 合成消息使用的群号
+GROUP_ID = 100
+
+# (计划发送时刻, 发送者QQ号, 群号, 消息文本)，时刻为相对阶段开始的秒数
+Message = Tuple[float, str, int, str]
+
+
+class SyntheticTraffic:
+    """按命令比例和玩家活跃度生成消息"""
+
+    def __init__(
+        self, seed: Seed, mix: Dict[str, float], skew: float, rng: random.Random
+    ):
+        self.seed = seed
+        self.rng = rng
+        self.commands = list(mix)
+        self.command_weights = list(accumulate(mix.values()))
+        # 第 k 活跃的玩家权重为 1 / k^skew
+        self.users = list(seed.users)
+        rng.shuffle(self.users)
+        self.user_weights = list(
+            accumulate(1 / (rank + 1) ** skew for rank in range(len(self.users)))
+        )
+        self.sect_names = list(seed.sects)
+        self._new_users = count(NEW_USER_BASE)
+        self._new_sects = count(1)
+
+    def next_message(self) -> Tuple[str, str]:
+        """生成一条消息
+
+        Returns:
+            (发送者QQ号, 消息文本)
+        """
+        rng = self.rng
+        command = rng.choices(self.commands, cum_weights=self.command_weights)[0]
+        if command == "开始修仙":
+            return str(next(self._new_users)), command
+        user_id = self.pick_user()
+        if command == "闲聊":
+            return user_id, rng.choice(CHATTER)
+        if command in ("修仙PK", "任命长老"):
+            return user_id, f"{command} {self.pick_user()}"
+        if command in ("加入门派", "门派战") and self.sect_names:
+            return user_id, f"{command} {rng.choice(self.sect_names)}"
+        if command == "创建门派":
+            return user_id, f"创建门派 压测门派{next(self._new_sects)}"
+        return user_id, command
+
+    def pick_user(self) -> str:
+        return self.rng.choices(self.users, cum_weights=self.user_weights)[0]
+
+    def arrivals(self, rate: float, duration: float) -> Iterator[Message]:
+        """泊松到达，平均每秒 rate 条"""
+        at = 0.0
+        while True:
+            at += self.rng.expovariate(rate)
+            if at >= duration:
+                return
+            user_id, text = self.next_message()
+            yield at, user_id, GROUP_ID, text
+
+
+def parse_log(paths: List[Path]) -> List[Message]:
+    """从每日日志还原群消息，时刻为相对第一条消息的秒数
+
+    日志时间不含年份，从文件名中的日期读取，读不到时按当前年份。
+    """
+    records = []
+    for path in paths:
+        match = LOG_DATE_PATTERN.search(path.name)
+        year = int(match.group(1)) if match else datetime.now().year
+        with path.open(encoding="utf-8", errors="replace") as f:
+            for line in f:
+                match = LOG_PATTERN.match(line.rstrip("\n"))
+                if not match:
+                    continue
+                stamp, user_id, group_id, text = match.groups()
+                try:
+                    text = ast.literal_eval(text)
+                except (ValueError, SyntaxError):
+                    continue
+                at = datetime.strptime(f"{year}-{stamp}", "%Y-%m-%d %H:%M:%S")
+                records.append((at.timestamp(), user_id, int(group_id), str(text)))
+    records.sort(key=lambda record: record[0])
+    if not records:
+        return []
+    start = records[0][0]
+    return [(at - start, *rest) for at, *rest in records]
+
+
+def replay_arrivals(
+    messages: List[Message], speed: float, duration: Optional[float]
+) -> Iterator[Message]:
+    """按原始间隔除以 speed 发送日志中的消息"""
+    for at, user_id, group_id, text in messages:
+        at /= speed
+        if duration and at >= duration:
+            return
+        yield at, user_id, group_id, text
+
+
+class StageStats:
+    """一级负载的统计"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def report(self, level: float, elapsed: float) -> dict:
+        done = len(self.latencies)
+        cuts = percentiles(self.latencies) if self.latencies else [0.0] * 99
+        slow = sum(latency > self.timeout for latency in self.latencies)
+        return {
+            "level": level,
+            "sent": self.sent,
+            "throughput": round(done / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(cuts[49] * 1000, 2),
+            "p95_ms": round(cuts[94] * 1000, 2),
+            "p99_ms": round(cuts[98] * 1000, 2),
+            "max_ms": round(max(self.latencies, default=0) * 1000, 2),
+            "error_rate": round(self.errors / self.sent, 4) if self.sent else 0.0,
+            "timeout_rate": round(slow / done, 4) if done else 0.0,
+            "max_in_flight": self.max_in_flight,
+        }
+
+
+class ErrorCounter:
+    """通过运行后处理钩子统计处理器抛出的异常
+
+    NoneBot 会捕获处理器中的异常并记录日志，handle_event 本身不会抛出。
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        from nonebot.message import run_postprocessor
+
+        @run_postprocessor
+        async def _count(exception: Optional[Exception]):
+            if exception is not None:
+                self.count += 1
+
+
+async def deliver(bot, message: Message, scheduled: float, stats: StageStats):
+    """处理一条消息，记录从计划时刻到处理完成的耗时"""
+    from nonebot.message import handle_event
+
+    _, user_id, group_id, text = message
+    loop = asyncio.get_running_loop()
+    stats.sent += 1
+    stats.in_flight += 1
+    stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+    try:
+        await handle_event(bot, make_event(user_id, text, group_id))
+    except Exception:
+        stats.errors += 1
+    else:
+        stats.latencies.append(loop.time() - scheduled)
+    finally:
+        stats.in_flight -= 1
+
+
+async def run_open_stage(
+    bot, arrivals: Iterator[Message], stats: StageStats, errors: ErrorCounter
+) -> float:
+    """按计划时刻发送，不等待回复（与适配器为每个事件创建任务相同）
+
+    Returns:
+        从开始到最后一条消息处理完成的秒数
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    errors_before = errors.count
+    tasks = set()
+    for message in arrivals:
+        scheduled = started + message[0]
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(deliver(bot, message, scheduled, stats))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    stats.errors += errors.count - errors_before
+    return loop.time() - started
+
+
+async def run_closed_stage(
+    bot,
+    traffic: SyntheticTraffic,
+    workers: int,
+    duration: float,
+    stats: StageStats,
+    errors: ErrorCounter,
+) -> float:
+    """workers 个发送者各自收到回复后立即发送下一条，持续 duration 秒"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + duration
+    errors_before = errors.count
+
+    async def worker():
+        while loop.time() < deadline:
+            user_id, text = traffic.next_message()
+            await deliver(bot, (0.0, user_id, GROUP_ID, text), loop.time(), stats)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    stats.errors += errors.count - errors_before
+    return loop.time() - started
+
+
+COLUMNS = (
+    ("消息数", "sent", "{}"),
+    ("吞吐(条/s)", "throughput", "{:.1f}"),
+    ("p50(ms)", "p50_ms", "{:.2f}"),
+    ("p95(ms)", "p95_ms", "{:.2f}"),
+    ("p99(ms)", "p99_ms", "{:.2f}"),
+    ("max(ms)", "max_ms", "{:.2f}"),
+    ("错误率", "error_rate", "{:.2%}"),
+    ("超时率", "timeout_rate", "{:.2%}"),
+    ("最大并发", "max_in_flight", "{}"),
+)
+
+
+def print_row(level_title: str, result: Optional[dict] = None):
+    if result is None:
+        print(
+            pad(level_title, 10, left=True)
+            + "".join(pad(title, 12) for title, _, _ in COLUMNS)
+        )
+        return
+    print(
+        pad(f"{result['level']:g}", 10, left=True)
+        + "".join(pad(fmt.format(result[key]), 12) for _, key, fmt in COLUMNS)
+    )
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def run(args) -> List[dict]:
+    bot = await start_plugin()
+    try:
+        rng = random.Random(args.seed)
+        messages = parse_log(args.replay) if args.replay else []
+        if args.replay:
+            if not messages:
+                raise SystemExit("日志中没有找到群消息记录")
+            user_ids = sorted({user_id for _, user_id, _, _ in messages})
+            seed = await seed_database(
+                0, args.sects, args.member_ratio, rng, user_ids=user_ids
+            )
+            span = messages[-1][0]
+            print(
+                f"回放 {len(messages)} 条消息，原始时长 {span:.0f} 秒，"
+                f"{len(user_ids)} 名玩家\n"
+            )
+        else:
+            seed = await seed_database(args.users, args.sects, args.member_ratio, rng)
+        traffic = SyntheticTraffic(seed, parse_mix(args.mix), args.skew, rng)
+        errors = ErrorCounter()
+        errors.install()
+
+        title = {"rate": "目标条/s", "workers": "并发数"}[args.mode]
+        print_row("加速倍数" if args.replay else title)
+        results = []
+        for level in args.stages:
+            stats = StageStats(args.timeout)
+            if args.replay:
+                elapsed = await run_open_stage(
+                    bot, replay_arrivals(messages, level, args.duration), stats, errors
+                )
+            elif args.mode == "rate":
+                elapsed = await run_open_stage(
+                    bot, traffic.arrivals(level, args.duration), stats, errors
+                )
+            else:
+                elapsed = await run_closed_stage(
+                    bot, traffic, int(level), args.duration, stats, errors
+                )
+            result = stats.report(level, elapsed)
+            results.append(result)
+            print_row("", result)
+        return results
+    finally:
+        await stop_plugin()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息负载测试")
+    parser.add_argument(
+        "--mode",
+        choices=("rate", "workers"),
+        default="rate",
+        help="rate: 各级为每秒消息数; workers: 各级为并发发送者数",
+    )
+    parser.add_argument(
+        "--stages",
+        type=lambda text: [float(v) for v in text.split(",")],
+        default=[25, 50, 100, 200, 400],
+        help="逐级负载，逗号分隔；回放日志时为加速倍数",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        help="每级持续秒数，默认 20；回放时默认回放完整日志",
+    )
+    parser.add_argument("--users", type=int, default=10000, help="预置玩家数")
+    parser.add_argument("--sects", type=int, default=20, help="预置门派数")
+    parser.add_argument(
+        "--member-ratio", type=float, default=0.8, help="预置玩家中门派成员的比例"
+    )
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="命令比例，如 修炼=3,探索=1")
+    parser.add_argument(
+        "--skew", type=float, default=1.1, help="玩家活跃度的 Zipf 指数，0 为均匀"
+    )
+    parser.add_argument(
+        "--replay", type=Path, nargs="+", help="回放 log.py 写入的每日日志"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=1.0, help="处理超过该秒数计为超时"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--save", type=Path, help="结果保存为 JSON")
+    parser.add_argument("--log-level", default="WARNING", help="NoneBot 日志级别")
+    args = parser.parse_args()
+    if not args.replay and args.duration is None:
+        args.duration = 20
+
+    with tempfile.TemporaryDirectory() as tmp:
+        init_plugin(Path(tmp) / "load.db", args.log_level)
+        results = asyncio.run(run(args))
+
+    if args.save:
+        args.save.write_text(
+            json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+修仙数值平衡模拟
+作者: biupiaa
+
+离线模拟大量玩家数月内的修炼、探索、渡劫和PK，输出境界分布、
+到达各境界的天数分位数和功德变化，用于上线前评估数值调整。
+
+与插件共用 formulas.py、constants.py 和探索事件库，所有玩家以 NumPy 数组
+整体推进，不需要启动机器人或数据库。
+
+用法:
+    pip install numpy
+    python scripts/simulate.py --players 1000000 --days 90
+"""
+
+import argparse
+import importlib.util
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent / "nonebot_plugin_dujie"
+
+
+def load_module(name: str):
+    """按路径加载插件中不依赖 NoneBot 的模块，不执行插件的 __init__"""
+    spec = importlib.util.spec_from_file_location(
+        f"dujie_{name}", PLUGIN_DIR / f"{name}.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+constants = load_module("constants")
+formulas = load_module("formulas")
+
+MAX_LEVEL = max(constants.REALMS)
+ELEMENTS = list(constants.ELEMENT_COEFFICIENTS)
+COEFFICIENTS = np.array([constants.ELEMENT_COEFFICIENTS[e] for e in ELEMENTS])
+POWER_BONUS = np.array([constants.ELEMENT_POWER_BONUS[e] for e in ELEMENTS])
+
+
+class EventTable:
+    """探索事件库的数组形式，按境界预先计算累积概率"""
+
+    def __init__(self, path: Path):
+        events = json.loads(path.read_text(encoding="utf-8"))
+        effects = [event.get("effect", {}) for event in events]
+        min_level = np.array([event.get("min_level", 1) for event in events])
+        weight = np.array([event.get("weight", 1) for event in events], dtype=float)
+        self.cultivation = np.array([e.get("cultivation", 0) for e in effects])
+        self.cultivation_pct = np.array(
+            [e.get("cultivation_pct", 0) for e in effects], dtype=float
+        )
+        self.karma = np.array([e.get("karma", 0) for e in effects])
+        self.artifact = np.array([bool(e.get("artifact")) for e in effects])
+        # 与 ExplorationEvent.available 相同：境界不低于 min_level 时可遇
+        levels = np.arange(MAX_LEVEL + 1)[:, None]
+        weights = np.where(min_level[None, :] <= levels, weight[None, :], 0.0)
+        # 每个境界一张别名表，按 境界 * 事件数 + 事件下标 展平
+        tables = [alias_table(row) for row in weights]
+        self.prob = np.concatenate([prob for prob, _ in tables])
+        self.alias = np.concatenate([alias for _, alias in tables])
+        self.size = len(events)
+
+    def sample(self, level: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """为每名玩家按其境界抽取一个事件下标"""
+        index = rng.integers(0, self.size, level.size)
+        slot = level * self.size + index
+        return np.where(rng.random(level.size) < self.prob[slot], index, self.alias[slot])
+
+
+def alias_table(weights: np.ndarray):
+    """按权重建立别名表 (Vose alias method)，与插件的 AliasTable 相同
+
+    Returns:
+        (接受概率, 别名下标)，权重全为 0 时返回均匀分布
+    """
+    size = len(weights)
+    prob = np.ones(size)
+    alias = np.arange(size)
+    total = weights.sum()
+    if total <= 0:
+        return prob, alias
+    scaled = weights * size / total
+    small = [i for i in range(size) if scaled[i] < 1]
+    large = [i for i in range(size) if scaled[i] >= 1]
+    while small and large:
+        s, g = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = g
+        scaled[g] -= 1 - scaled[s]
+        (small if scaled[g] < 1 else large).append(g)
+    return prob, alias
+
+
+class Simulation:
+    """一批合成玩家的状态，每个数组下标对应一名玩家"""
+
+    def __init__(self, players: int, events: EventTable, seed: int = None):
+        self.rng = np.random.default_rng(seed)
+        self.events = events
+        self.players = players
+        # 与创建角色相同：灵根随机，从练气期开始
+        element = self.rng.integers(0, len(ELEMENTS), players)
+        self.coefficient = COEFFICIENTS[element]
+        self.power_bonus = POWER_BONUS[element]
+        self.level = np.ones(players, dtype=np.int64)
+        self.cultivation = np.zeros(players, dtype=np.int64)
+        self.karma = np.zeros(players, dtype=np.int64)
+        self.artifacts = np.zeros(players, dtype=np.int64)
+        # 境界 -> 每名玩家首次到达的天数，未到达为 -1
+        self.reached = {
+            level: np.full(players, -1, dtype=np.int32)
+            for level in range(2, MAX_LEVEL + 1)
+        }
+        self.tribulations = 0
+        self.tribulation_successes = 0
+
+    def cultivate(self):
+        """所有玩家修炼一次，修为达到要求时自动突破一个境界"""
+        noise = self.rng.uniform(
+            -formulas.CULTIVATION_NOISE, formulas.CULTIVATION_NOISE, self.players
+        )
+        self.cultivation += formulas.cultivation_gain(
+            self.level, self.coefficient, noise
+        )
+        next_level = self.level + 1
+        breakthrough = (next_level <= MAX_LEVEL) & (
+            self.cultivation >= formulas.breakthrough_cultivation(next_level)
+        )
+        self.level[breakthrough] += 1
+
+    def explore(self):
+        """所有玩家探索一次"""
+        events = self.events
+        choice = events.sample(self.level, self.rng)
+        flat = events.cultivation[choice]
+        pct = events.cultivation_pct[choice]
+        karma = events.karma[choice]
+        # 与 apply_event_effect 相同：只有事件带该效果时才变化，且不低于 0
+        delta = formulas.exploration_cultivation(self.cultivation, flat, pct)
+        changed = (flat != 0) | (pct != 0)
+        self.cultivation = np.where(
+            changed, np.maximum(0, self.cultivation + delta), self.cultivation
+        )
+        self.karma = np.where(karma != 0, np.maximum(0, self.karma + karma), self.karma)
+        self.artifacts += events.artifact[choice]
+
+    def tribulate(self):
+        """修为足够且未到最高境界的玩家渡劫一次"""
+        required = formulas.breakthrough_cultivation(self.level + 1)
+        eligible = (self.level < formulas.MAX_TRIBULATION_LEVEL) & (
+            self.cultivation >= required
+        )
+        success = eligible & (
+            self.rng.random(self.players)
+            < formulas.tribulation_success_rate(self.level)
+        )
+        failure = eligible & ~success
+        self.cultivation -= np.where(success, required, 0)
+        self.cultivation -= np.where(failure, formulas.tribulation_loss(required), 0)
+        self.level += success
+        self.tribulations += int(eligible.sum())
+        self.tribulation_successes += int(success.sum())
+
+    def pk(self):
+        """每名玩家向一名随机对手发起一次PK
+
+        同一轮中所有PK以本轮开始时的状态结算。
+        """
+        n = self.players
+        challenger = np.arange(n)
+        defender = self.rng.integers(0, n - 1, n)
+        defender += defender >= challenger
+        power = formulas.combat_power(
+            self.cultivation, self.level, self.power_bonus, self.artifacts
+        )
+        wins = self.rng.random(n) < formulas.pk_win_rate(
+            power[challenger], power[defender]
+        )
+        reward = formulas.pk_exp_reward(self.level[challenger], self.level[defender])
+        winner = np.where(wins, challenger, defender)
+        loser = np.where(wins, defender, challenger)
+        self.cultivation += np.bincount(winner, weights=reward, minlength=n).astype(
+            np.int64
+        )
+        self.karma += formulas.PK_KARMA * (
+            np.bincount(winner, minlength=n) - np.bincount(loser, minlength=n)
+        )
+
+    def record(self, day: int):
+        """记录当天首次到达各境界的玩家"""
+        for level, reached in self.reached.items():
+            reached[(self.level >= level) & (reached < 0)] = day
+
+    def run_day(self, day: int, cultivate: int, explore: int, pk: int, tribulate: bool):
+        for _ in range(cultivate):
+            self.cultivate()
+        for _ in range(explore):
+            self.explore()
+        if tribulate:
+            self.tribulate()
+        for _ in range(pk):
+            self.pk()
+        self.record(day)
+
+
+def report_karma(sim: Simulation, day: int):
+    karma = sim.karma
+    p10, p50, p90 = np.percentile(karma, [10, 50, 90])
+    print(
+        f"  第{day:>4}天  平均 {karma.mean():>9.1f}  p10 {p10:>8.0f}"
+        f"  p50 {p50:>8.0f}  p90 {p90:>8.0f}"
+    )
+
+
+def report(sim: Simulation, days: int):
+    n = sim.players
+    print(f"\n境界分布（第{days}天）:")
+    counts = np.bincount(sim.level, minlength=MAX_LEVEL + 1)
+    for level, name in constants.REALMS.items():
+        print(f"  {name}  {counts[level]:>10}  {counts[level] / n:7.2%}")
+
+    print("\n到达境界所需天数:")
+    for level, reached in sim.reached.items():
+        days_taken = reached[reached >= 0]
+        name = constants.REALMS[level]
+        if not days_taken.size:
+            print(f"  {name}  无人到达")
+            continue
+        p50, p90, p99 = np.percentile(days_taken, [50, 90, 99])
+        print(
+            f"  {name}  到达 {days_taken.size / n:7.2%}"
+            f"  p50 {p50:>6.1f}  p90 {p90:>6.1f}  p99 {p99:>6.1f}"
+        )
+
+    if sim.tribulations:
+        print(
+            f"\n渡劫 {sim.tribulations} 次，成功率 "
+            f"{sim.tribulation_successes / sim.tribulations:.2%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="修仙数值平衡模拟")
+    parser.add_argument("--players", type=int, default=100000, help="模拟玩家数")
+    parser.add_argument("--days", type=int, default=90, help="模拟天数")
+    parser.add_argument("--cultivate", type=int, default=8, help="每人每天修炼次数")
+    parser.add_argument("--explore", type=int, default=3, help="每人每天探索次数")
+    parser.add_argument("--pk", type=int, default=1, help="每人每天发起PK次数")
+    parser.add_argument(
+        "--no-tribulation", action="store_true", help="不渡劫，只靠修炼自动突破"
+    )
+    parser.add_argument(
+        "--events",
+        type=Path,
+        default=PLUGIN_DIR / "exploration_events.json",
+        help="探索事件库路径",
+    )
+    parser.add_argument("--report-every", type=int, default=7, help="功德统计间隔(天)")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    args = parser.parse_args()
+
+    sim = Simulation(args.players, EventTable(args.events), args.seed)
+    started = time.perf_counter()
+    print("功德变化:")
+    for day in range(1, args.days + 1):
+        sim.run_day(
+            day, args.cultivate, args.explore, args.pk, not args.no_tribulation
+        )
+        if day % args.report_every == 0 or day == args.days:
+            report_karma(sim, day)
+    elapsed = time.perf_counter() - started
+
+    report(sim, args.days)
+    print(f"\n模拟 {args.players} 名玩家 {args.days} 天，用时 {elapsed:.1f} 秒")
+
+
+if __name__ == "__main__":
+    main()
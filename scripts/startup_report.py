@@ -0,0 +1,170 @@
+"""
+启动耗时报告
+作者: biupiaa
+
+在新的解释器中用 python -X importtime 加载插件并执行启动钩子，输出:
+    各阶段耗时: 导入 NoneBot/适配器/ORM 等依赖、加载插件、执行启动钩子
+    自身导入耗时最多的模块，以及按顶层包汇总的导入耗时
+    插件各子模块的导入耗时（自身 / 含其导入的模块）
+    每个启动钩子的耗时
+
+数据库默认为临时 SQLite；用 --db 指定已有数据库的副本时，
+加载排行榜、预热缓存等钩子的耗时与线上接近。需要在插件的运行环境中执行。
+
+用法:
+    python scripts/startup_report.py
+    python scripts/startup_report.py --db data/db/xiuxian-copy.db --top 30
+"""
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+PLUGIN = "nonebot_plugin_dujie"
+
+# python -X importtime 的输出，例如:
+# import time:       410 |        410 |   nonebot_plugin_dujie.constants
+IMPORT_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+# 子进程在最后一行输出的结果前缀
+RESULT_PREFIX = "STARTUP_REPORT "
+
+
+def run_child(args):
+    """子进程：加载插件并执行启动钩子，输出各阶段耗时"""
+    started = time.perf_counter()
+    import asyncio
+    import tempfile
+
+    import nonebot
+    from bench_commands import init_plugin, start_plugin, stop_plugin
+
+    phases = {"依赖导入": time.perf_counter() - started}
+
+    hooks: List[Tuple[str, float]] = []
+
+    def timed(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        async def wrapper():
+            t = time.perf_counter()
+            result = func()
+            if asyncio.iscoroutine(result):
+                await result
+            hooks.append((name, time.perf_counter() - t))
+
+        return wrapper
+
+    async def startup():
+        lifespan = nonebot.get_driver()._lifespan
+        lifespan._startup_funcs = [timed(f) for f in lifespan._startup_funcs]
+        t = time.perf_counter()
+        await start_plugin()
+        phases["启动钩子"] = time.perf_counter() - t
+        await stop_plugin()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t = time.perf_counter()
+        init_plugin(args.db or Path(tmp) / "startup.db", args.log_level)
+        phases["加载插件"] = time.perf_counter() - t
+        asyncio.run(startup())
+
+    print(RESULT_PREFIX + json.dumps({"phases": phases, "hooks": hooks}))
+
+
+def parse_importtime(lines: List[str]) -> List[Tuple[str, int, int]]:
+    """解析 -X importtime 输出，返回 (模块, 自身微秒, 累计微秒)"""
+    modules = []
+    for line in lines:
+        match = IMPORT_PATTERN.match(line)
+        if match:
+            modules.append((match[4], int(match[1]), int(match[2])))
+    return modules
+
+
+def print_table(title: str, rows: List[Tuple[str, str]]):
+    from bench_commands import display_width, pad
+
+    print(f"\n{title}")
+    width = max((display_width(name) for name, _ in rows), default=0)
+    for name, value in rows:
+        print(f"  {pad(name, width, left=True)}  {value}")
+
+
+def report(modules: List[Tuple[str, int, int]], result: dict, top: int):
+    phases = result["phases"]
+    print_table(
+        "各阶段耗时",
+        [(name, f"{seconds * 1000:8.1f} ms") for name, seconds in phases.items()]
+        + [("合计", f"{sum(phases.values()) * 1000:8.1f} ms")],
+    )
+
+    by_self = sorted(modules, key=lambda m: m[1], reverse=True)[:top]
+    print_table(
+        f"自身导入耗时最多的 {top} 个模块（自身 / 累计）",
+        [
+            (name, f"{own / 1000:8.1f} / {cum / 1000:8.1f} ms")
+            for name, own, cum in by_self
+        ],
+    )
+
+    packages: Dict[str, int] = defaultdict(int)
+    for name, own, _ in modules:
+        packages[name.split(".")[0]] += own
+    ordered = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    print_table(
+        "按顶层包汇总的导入耗时",
+        [(name, f"{own / 1000:8.1f} ms") for name, own in ordered],
+    )
+
+    plugin = [m for m in modules if m[0] == PLUGIN or m[0].startswith(PLUGIN + ".")]
+    print_table(
+        "插件子模块（自身 / 累计，累计包含其首次导入的依赖）",
+        [
+            (name, f"{own / 1000:8.1f} / {cum / 1000:8.1f} ms")
+            for name, own, cum in sorted(plugin, key=lambda m: m[2], reverse=True)
+        ],
+    )
+
+    print_table(
+        "启动钩子",
+        [(name, f"{seconds * 1000:8.1f} ms") for name, seconds in result["hooks"]],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动耗时报告")
+    parser.add_argument(
+        "--db", type=Path, help="使用已有的 SQLite 数据库（会被修改，请用副本）"
+    )
+    parser.add_argument("--top", type=int, default=15, help="列出的模块数")
+    parser.add_argument("--log-level", default="WARNING", help="NoneBot 日志级别")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    command = [sys.executable, "-X", "importtime", __file__, "--child"]
+    command += ["--log-level", args.log_level]
+    if args.db:
+        command += ["--db", str(args.db)]
+    proc = subprocess.run(command, capture_output=True, text=True)
+    lines = proc.stdout.splitlines()
+    if proc.returncode or not lines or not lines[-1].startswith(RESULT_PREFIX):
+        sys.stderr.write(proc.stderr)
+        sys.exit(proc.returncode or 1)
+
+    result = json.loads(lines[-1][len(RESULT_PREFIX):])
+    report(parse_importtime(proc.stderr.splitlines()), result, args.top)
+
+
+if __name__ == "__main__":
+    main()